@@ -0,0 +1,127 @@
+import os
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+import settings
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class DownloadError(Exception):
+    pass
+
+
+@contextmanager
+def file_lock(path):
+    # Removed once released, so a waiter that got the lock of a removed file locks the new one instead
+    while True:
+        lock = open(path, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+    try:
+        yield
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+class BaseAPI(object):
+    def __init__(self, auth=None, verify=False, pool_size=settings.Download.POOL_SIZE):
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.verify = verify
+        # Keep-alive connections, pooled per host
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, url, method='get', **kwargs):
+        assert method in ['get', 'post', 'delete', 'put']
+        response = getattr(self.session, method)(url, verify=self.verify, **kwargs)
+        return response
+
+    def _download(self, url, part_path, block_size):
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        # Ranges refer to the unencoded body, which is what the part file holds
+        headers = {'Range': 'bytes={}-'.format(offset), 'Accept-Encoding': 'identity'} if offset else {}
+        response = self.session.get(url, stream=True, headers=headers, timeout=settings.Download.TIMEOUT)
+        with response:
+            if response.status_code == 416:
+                os.remove(part_path) # stale part file, start over
+                return self._download(url, part_path, block_size)
+            if response.status_code not in (200, 206):
+                return response
+            hasher = hashlib.md5()
+            if response.status_code == 206:
+                logger.info('Resuming download at {} bytes: {}'.format(offset, url))
+                with open(part_path, 'rb') as f:
+                    for data in iter(lambda: f.read(block_size), b''):
+                        hasher.update(data)
+                mode = 'ab'
+            else:
+                mode = 'wb'
+            written = 0
+            with open(part_path, mode) as out_file:
+                for data in response.iter_content(block_size):
+                    hasher.update(data)
+                    out_file.write(data)
+                    written += len(data)
+            length = response.headers.get('Content-Length')
+            if length and 'Content-Encoding' not in response.headers and written < int(length):
+                raise requests.exceptions.ConnectionError('Truncated body ({} < {} bytes)'.format(written, length))
+        response.file_hash = hasher.hexdigest()
+        return response
+
+    def download(self, url, filepath, expected_hash=None, retries=settings.Download.RETRIES, block_size=65536):
+        # Stream into a part file, resume it on failure and only move it in place once complete (and verified)
+        part_path = filepath + '.part'
+        with file_lock(filepath + '.lock'):
+            for attempt in range(retries + 1):
+                try:
+                    response = self._download(url, part_path, block_size)
+                except requests.exceptions.RequestException as e:
+                    logger.info('Download interrupted [{}/{}]: {}'.format(attempt + 1, retries + 1, e))
+                    continue
+                if response.status_code not in (200, 206):
+                    return response
+                if expected_hash and response.file_hash != expected_hash:
+                    os.remove(part_path)
+                    raise DownloadError('Hash mismatch', url, response.file_hash, expected_hash)
+                os.replace(part_path, filepath)
+                return response
+        raise DownloadError('Download failed', url, retries + 1)
+
+class API(BaseAPI):
+    def __init__(self, base_url, auth=None):
+        super().__init__(auth=auth)
+        self.base_url = base_url
+
+    @property
+    def base(self):
+        # Property rather than attribute: super objects cannot be pickled to worker processes
+        return super()
+
+    def request(self, id=None, action=None, method='get', **kwargs):
+        assert method in ['get', 'post', 'delete', 'put']
+        url = self.base_url
+        if id: url += str(id) + '/'
+        if action: url += format(action) + '/'
+        return super().request(url, method=method, **kwargs)
@@ -0,0 +1,69 @@
+import os
+import logging
+
+import settings
+import utils
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class ArtifactIndex(object):
+    """
+    Persistent (path, size, mtime, inode) -> hash index of the files under AGENTS_PATH and SUITES_PATH.
+    A file whose stat is unchanged is not read again.
+    """
+    def __init__(self, path=settings.ARTIFACT_INDEX_PATH):
+        self.path = path
+        with utils.connect(self.path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT)''')
+            db.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+
+    def lookup(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with utils.connect(self.path) as db:
+            row = db.execute('SELECT hash FROM files WHERE path=? AND size=? AND mtime_ns=? AND inode=?',
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino)).fetchone()
+        return row[0] if row else None
+
+    def record(self, path, file_hash):
+        stat = os.stat(path)
+        with utils.connect(self.path) as db:
+            db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, file_hash))
+
+    def hash(self, path):
+        file_hash = self.lookup(path)
+        if file_hash is None:
+            with open(path, 'rb') as f:
+                file_hash = utils.hash_file(f)
+            self.record(path, file_hash)
+        return file_hash
+
+    def dedupe(self, path, file_hash):
+        # Replace the file with a hard link to an identical one that is already indexed
+        with utils.connect(self.path) as db:
+            rows = db.execute('SELECT path FROM files WHERE hash=? AND path!=?', (file_hash, path)).fetchall()
+        for (other,) in rows:
+            if self.lookup(other) != file_hash:
+                continue # changed or removed since it was indexed
+            if os.path.samefile(path, other):
+                return other
+            tmp_path = '{}.{}'.format(path, utils.generate_secure_string(8))
+            try:
+                os.link(other, tmp_path)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logger.info('Dedupe failed for {}: {}'.format(path, e))
+                return None
+            self.record(path, file_hash)
+            logger.info('Deduplicated {} -> {}'.format(path, other))
+            return other
+        return None
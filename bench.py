@@ -0,0 +1,375 @@
+"""
+End-to-end throughput benchmark of the watcher on one machine, without aiVLE or sandboxes.
+
+A local stand-in of the aiVLE job, task and submission API serves synthetic suites and agents,
+and workers run with a fake client whose image pulls, installs and runs only sleep.
+Everything else (polling, claiming, downloads, artifact index, outbox, metrics) is the real code path.
+
+    python bench.py --jobs 200 --processes 4 --run-delay 2
+"""
+import os
+import io
+import re
+import json
+import time
+import random
+import shutil
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Runner modules are imported once the environment points them at the stand-in, see main()
+JOBS = 200
+TASKS = 4
+PROCESSES = 4
+AGENT_SIZE = 100 # KB
+SUITE_SIZE = 1000 # KB
+PULL_DELAY = 0.5 # seconds
+INSTALL_DELAY = 1 # seconds, per pip install
+RUN_DELAY = 2 # seconds
+JITTER = 0.2 # fraction of each delay
+
+
+def synthetic_zip(name, size):
+    # Incompressible payload, so sizes on the wire are what they say
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as f:
+        f.writestr('{}/__init__.py'.format(name), '')
+        f.writestr('{}/data.bin'.format(name), random.Random(name).getrandbits(8 * size * 1000).to_bytes(size * 1000, 'little'))
+    return buffer.getvalue()
+
+
+class FakeAPI(object):
+    """
+    In-memory aiVLE: a queue of jobs spread over a few tasks, each with its own agent.
+    Records when each job was queued, claimed and ended.
+    """
+    def __init__(self, jobs, tasks, agent_size, suite_size, page_size=50):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.page_size = page_size
+        self.url = None
+        self.files = {}
+        self.tasks = {}
+        for task_id in range(1, tasks + 1):
+            self.add_file('suite-{}.zip'.format(task_id), synthetic_zip('suite{}'.format(task_id), suite_size))
+            self.tasks[task_id] = {'id': task_id, 'run_time_limit': 3600, 'max_image_size': 1000000}
+        self.jobs = {}
+        for job_id in range(1, jobs + 1):
+            self.add_file('agent-{}.zip'.format(job_id), synthetic_zip('agent{}'.format(job_id), agent_size))
+            self.jobs[job_id] = {'id': job_id, 'task_id': (job_id - 1) % tasks + 1, 'runner': 'PY', 'docker': None,
+                'status': 'Q', 'queued': time.time(), 'claimed': None, 'ended': None, 'result': None}
+        self.conflicts = 0
+
+    def add_file(self, name, data):
+        self.files[name] = (data, hashlib.md5(data).hexdigest())
+
+    def file_url(self, name):
+        return '{}files/{}'.format(self.url, name)
+
+    def job(self, job):
+        return {'id': job['id'], 'task': '{}tasks/{}/'.format(self.url, job['task_id']), 'runner': job['runner'],
+            'docker': job['docker'], 'status': job['status'], 'file_url': self.file_url('agent-{}.zip'.format(job['id']))}
+
+    def task(self, task_id):
+        name = 'suite-{}.zip'.format(task_id)
+        return dict(self.tasks[task_id], file_url=self.file_url(name), file_hash=self.files[name][1])
+
+    def queued(self):
+        with self.lock:
+            return [self.job(job) for job in self.jobs.values() if job['status'] == 'Q']
+
+    def claim(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] != 'Q':
+                self.conflicts += 1
+                return False
+            job['status'], job['claimed'] = 'R', time.time()
+            return True
+
+    def end(self, job_id, data):
+        with self.lock:
+            job = self.jobs[job_id]
+            if job['ended'] is None:
+                job['ended'] = time.time()
+            job['status'], job['result'] = data['status'], data
+            if all(job['ended'] is not None for job in self.jobs.values()):
+                self.done.set()
+
+    def submissions(self, page):
+        ids = sorted(self.jobs)[(page - 1) * self.page_size:page * self.page_size]
+        more = page * self.page_size < len(self.jobs)
+        results = []
+        for job_id in ids:
+            data, file_hash = self.files['agent-{}.zip'.format(job_id)]
+            results.append({'id': job_id, 'file_url': self.file_url('agent-{}.zip'.format(job_id)), 'file_hash': file_hash, 'file_size': len(data)})
+        return {'next': '{}submissions/?page={}'.format(self.url, page + 1) if more else None, 'results': results}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like aiVLE behind a proxy
+
+    def reply(self, status, body=None, content_type='application/json'):
+        if body is None:
+            body = b''
+        elif not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def do_GET(self):
+        api = self.server.api
+        path, _, query = self.path.partition('?')
+        if path == '/jobs/':
+            return self.reply(200, api.queued())
+        match = re.match(r'^/tasks/(\d+)/$', path)
+        if match and int(match.group(1)) in api.tasks:
+            return self.reply(200, api.task(int(match.group(1))))
+        match = re.match(r'^/files/([\w.-]+)$', path)
+        if match and match.group(1) in api.files:
+            return self.reply(200, api.files[match.group(1)][0], content_type='application/zip')
+        if path == '/submissions/':
+            page = re.search(r'page=(\d+)', query)
+            return self.reply(200, api.submissions(int(page.group(1)) if page else 1))
+        self.reply(404)
+
+    def do_POST(self):
+        api = self.server.api
+        data = self.read_json()
+        match = re.match(r'^/jobs/(\d+)/(run|end)/$', self.path)
+        if not match or int(match.group(1)) not in api.jobs:
+            return self.reply(404)
+        job_id, action = int(match.group(1)), match.group(2)
+        if action == 'run':
+            return self.reply(200 if api.claim(job_id) else 409)
+        api.end(job_id, data)
+        self.reply(200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(api):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.api = api
+    api.url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, name='fake-aivle', daemon=True).start()
+    return server
+
+
+class FakeImages(object):
+    def __init__(self, delays):
+        self.delays = delays
+
+    def pull(self, name):
+        self.delays.sleep('pull')
+
+    def get(self, name):
+        return FakeImage()
+
+    def delete(self, name):
+        pass
+
+
+class FakeImage(object):
+    def __init__(self):
+        self.attrs = {'Size': 0}
+
+
+class FakeContainer(object):
+    def __init__(self, delays, name):
+        self.delays = delays
+        self.name = name
+        self.runner_installed = False
+
+    def start(self):
+        pass
+
+    def exec_stream(self, command):
+        # Wheels are never built, installs fall back to a plain pip install
+        if command.startswith('pip wheel'):
+            return 1
+        if command.startswith('pip install'):
+            self.delays.sleep('install')
+            yield b'Successfully installed\n', None
+            return 0
+        if command == 'runner':
+            self.delays.sleep('run')
+            yield json.dumps({'point': random.random(), 'test_cases': []}).encode('utf8') + b'\n', None
+            return 0
+        yield None, 'Unknown command: {}\n'.format(command).encode('utf8')
+        return 127
+
+    def kill(self):
+        pass
+
+    def remove(self):
+        pass
+
+
+class FakeContainers(object):
+    def __init__(self, delays):
+        self.delays = delays
+
+    def create(self, image, **kwargs):
+        return FakeContainer(self.delays, kwargs.get('name'))
+
+
+class FakeNetwork(object):
+    def connect(self, container):
+        pass
+
+    def disconnect(self, container):
+        pass
+
+
+class FakeNetworks(object):
+    def list(self, names=[]):
+        return [FakeNetwork()]
+
+
+class Delays(object):
+    def __init__(self, pull, install, run, jitter):
+        self.delays = {'pull': pull, 'install': install, 'run': run}
+        self.jitter = jitter
+
+    def sleep(self, name):
+        time.sleep(self.delays[name] * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class FakeClient(object):
+    # Stands in for core.client, same surface as virtualenv.Client
+    def __init__(self, delays):
+        self.images = FakeImages(delays)
+        self.containers = FakeContainers(delays)
+        self.networks = FakeNetworks()
+
+
+def init_worker(delays):
+    import watcher, core
+    watcher.init_worker()
+    core.client = FakeClient(delays)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(api, start, end, log_path):
+    jobs = list(api.jobs.values())
+    latencies = [job['ended'] - job['claimed'] for job in jobs if job['ended'] and job['claimed']]
+    turnarounds = [job['ended'] - job['queued'] for job in jobs if job['ended']]
+    errors = [job for job in jobs if job['status'] == 'E']
+    elapsed = end - start
+    print('Jobs:        {} ({} errors, {} claim conflicts)'.format(len(jobs), len(errors), api.conflicts))
+    print('Elapsed:     {:.1f}s'.format(elapsed))
+    print('Throughput:  {:.1f} jobs/hour'.format(len(latencies) * 3600 / elapsed if elapsed else 0))
+    print('Latency:     p50 {:.2f}s, p99 {:.2f}s (claim to result)'.format(percentile(latencies, 50), percentile(latencies, 99)))
+    print('Turnaround:  p50 {:.2f}s, p99 {:.2f}s (queued to result)'.format(percentile(turnarounds, 50), percentile(turnarounds, 99)))
+    phases = {}
+    if os.path.isfile(log_path):
+        with open(log_path) as f:
+            for line in f:
+                for phase, seconds in json.loads(line)['phases'].items():
+                    phases.setdefault(phase, []).append(seconds)
+    if phases:
+        print('{:<16} {:>8} {:>8} {:>8} {:>10}'.format('Phase', 'mean', 'p50', 'p99', 'total'))
+        for phase, values in sorted(phases.items(), key=lambda item: -sum(item[1])):
+            print('{:<16} {:>8.3f} {:>8.3f} {:>8.3f} {:>10.1f}'.format(
+                phase, sum(values) / len(values), percentile(values, 50), percentile(values, 99), sum(values)))
+    if errors:
+        print('First error: {}'.format(errors[0]['result']['notes']))
+
+
+def main(args):
+    base_path = tempfile.mkdtemp(prefix='aivle-bench-')
+    api = FakeAPI(args.jobs, args.tasks, args.agent_size, args.suite_size)
+    serve(api)
+    # Before the runner modules read their settings, workers inherit the environment
+    os.environ.update({
+        'RUNNER_BASE_PATH': base_path,
+        'VIRTUALENV_ROOT': os.path.join(base_path, 'virtualenvs'),
+        'VIRTUALENV_POOL_SIZE': '0',
+        'XDG_RUNTIME_DIR': base_path,
+        'USER': os.environ.get('USER') or 'bench',
+        'WATCHER_API': api.url + 'jobs/',
+        'SUBMISSION_API': api.url + 'submissions/',
+        'WATCHER_SLEEP': '1',
+        'WATCHER_ASYNC': '1' if args.use_async else '0',
+        'METRICS_PORT': '0',
+    })
+    import settings
+    import watcher
+    from api import API
+    for path in [settings.AGENTS_PATH, settings.SUITES_PATH, settings.LOG_PATH]:
+        os.makedirs(path, exist_ok=True)
+    delays = Delays(args.pull_delay, args.install_delay, args.run_delay, args.jitter)
+    runner_api = API(settings.Watcher.API)
+    print('Benchmarking {} with {} jobs, {} processes in {}'.format(
+        'AsyncJobWatcher' if args.use_async else 'JobWatcher', args.jobs, args.processes, base_path))
+    start = time.time()
+    try:
+        if args.use_async:
+            import asyncio
+            w = watcher.AsyncJobWatcher(runner_api, sleep=settings.Watcher.SLEEP, processes=args.processes,
+                initializer=init_worker, initargs=(delays,))
+            async def stop():
+                await asyncio.get_running_loop().run_in_executor(None, api.done.wait)
+                w.stopping.set()
+            async def run():
+                stopper = asyncio.ensure_future(stop())
+                await w.watch()
+                stopper.cancel()
+            asyncio.run(run())
+        else:
+            w = watcher.JobWatcher(runner_api, sleep=settings.Watcher.SLEEP, processes=args.processes,
+                initializer=init_worker, initargs=(delays,))
+            thread = threading.Thread(target=w.watch, name='bench-watcher')
+            thread.start()
+            api.done.wait()
+            w.stopping.set()
+            thread.join()
+        end = max(job['ended'] for job in api.jobs.values())
+        report(api, start, end, settings.Metrics.LOG_PATH)
+        if args.mirror:
+            from download_agents import Mirror
+            shutil.rmtree(settings.AGENTS_PATH)
+            os.makedirs(settings.AGENTS_PATH)
+            mirror_start = time.time()
+            stats = Mirror(API(settings.Submission.API)).run(settings.Submission.API)
+            print('Mirror:      {} agents in {:.1f}s'.format(stats['downloaded'], time.time() - mirror_start))
+    finally:
+        if not args.keep:
+            shutil.rmtree(base_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Watcher throughput benchmark against a local aiVLE stand-in')
+    parser.add_argument('--jobs', type=int, default=JOBS)
+    parser.add_argument('--tasks', type=int, default=TASKS)
+    parser.add_argument('--processes', type=int, default=PROCESSES)
+    parser.add_argument('--agent-size', type=int, default=AGENT_SIZE, help='KB')
+    parser.add_argument('--suite-size', type=int, default=SUITE_SIZE, help='KB')
+    parser.add_argument('--pull-delay', type=float, default=PULL_DELAY, help='seconds')
+    parser.add_argument('--install-delay', type=float, default=INSTALL_DELAY, help='seconds, per install')
+    parser.add_argument('--run-delay', type=float, default=RUN_DELAY, help='seconds')
+    parser.add_argument('--jitter', type=float, default=JITTER, help='fraction of each delay')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='AsyncJobWatcher instead of JobWatcher')
+    parser.add_argument('--mirror', action='store_true', help='also time a full agent mirror (download_agents)')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    main(parser.parse_args())
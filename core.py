@@ -1,8 +1,21 @@
 import os
 import json
+import time
+import sqlite3
+import hashlib
+import functools
 import logging
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
 import settings
 import utils
+import deadline
+import metrics
+import layers
+from wheelhouse import Wheelhouse
+from artifacts import ArtifactIndex
+from results import ResultStore
+from reaper import Reaper
 
 
 logging.basicConfig()
@@ -11,13 +24,37 @@ logger.setLevel("DEBUG")
 
 if settings.Runner.USE_DOCKER:
 	import docker
-	client = docker.from_env()
+	from imagecache import ImageCache
+	from registry import Registry
 else:
 	import virtualenv
-	client = virtualenv.Client()
+
+
+def get_client():
+	if settings.Runner.USE_DOCKER:
+		return docker.from_env()
+	return virtualenv.Client()
+
+client = get_client()
+wheelhouse = Wheelhouse(getattr(client, 'wheelhouse_path', settings.Wheelhouse.PATH), staging_path=getattr(client, 'staging_path', None))
+image_cache = ImageCache(client) if settings.Runner.USE_DOCKER else None
+registry = Registry() if settings.Runner.USE_DOCKER else None
+artifact_index = ArtifactIndex()
+result_store = ResultStore()
+dependency_layers = layers.Layers(client.layers_path) if hasattr(client, 'layers_path') else None
+reaper = Reaper(client, wheelhouse, image_cache)
+wheelhouse.purge('agent-')
 
 print('Using:', client)
 
+@functools.lru_cache()
+def runner_hash():
+	return utils.hash_dir(settings.RUNNER_PATH)
+
+
+SHARED_BUILDS = ['runner', 'suite'] # cached in the wheelhouse, agents never are
+
+
 class RunnerType:
 	Docker = 'DO'
 	Python = 'PY'
@@ -48,6 +85,19 @@ class MalformedOutputError(Exception):
 	pass
 
 
+def parse_result(output):
+	try:
+		return json.loads(output)
+	except json.JSONDecodeError as e:
+		# Anything the agent printed comes before the result, which is the last line
+		lines = output.strip().splitlines()
+		try:
+			return json.loads(lines[-1]) if lines else None
+		except json.JSONDecodeError:
+			pass
+		raise MalformedOutputError(str(e), output[-settings.Runner.ERROR_TAIL_SIZE * 1000:])
+
+
 class Runnable(object):
 	def __init__(self, ts_id, agent_id, runner_type=RunnerType.Python, 
 		pull_time_limit=settings.Runner.PULL_TIME_LIMIT, setup_time_limit=settings.Runner.SETUP_TIME_LIMIT, 
@@ -66,6 +116,19 @@ class Runnable(object):
 		self.run_time_limit = run_time_limit
 		self.max_image_size = max_image_size
 		self.name = kwargs.get('name', None)
+		self.suite_hash = kwargs.get('suite_hash', None)
+		self.cpus = kwargs.get('cpus', None) # cores to pin to
+		self.memory = kwargs.get('memory', None) # MB
+		self.base = kwargs.get('base', None) # prepared Runnable to start from, see Batch
+		self.record = kwargs.get('record', True) # into the result store, callers with more context record themselves
+		self.reap = kwargs.get('reap', False) # leave removal to the watcher's reaper
+		self.baked = False
+		self.layered = False # agent dependencies come from a shared layer
+		self.artifacts = set() # wheelhouse artifacts mounted into the container
+		self.killed = False # by a time limit, see abort()
+		self.held = [] # images held in the image cache until destroy()
+		self.job_log = None
+		self.timings = metrics.Timings()
 
 	@property
 	def container_name(self):
@@ -73,10 +136,6 @@ class Runnable(object):
 			return self.name
 		return "aiVLE-runner-TS.{}-A.{}-{}".format(self.ts_id, self.agent_id, self.rand)
 
-	@property
-	def output_path(self):
-		return os.path.join(settings.OUTPUT_PATH, str(self.ts_id), "{}.json".format(self.agent_id))
-
 	def log(self, message, log_type='info'):
 		getattr(logger, log_type)("[TS={}, A={}, R={}, M={}] {}".format(self.ts_id, self.agent_id, self.runner_type, self.metadata, message))
 
@@ -94,37 +153,335 @@ class Runnable(object):
 	def path_in_host(self, name):
 		if name == 'agent': return os.path.join(settings.AGENTS_PATH, "{}.zip".format(self.agent_id))
 		elif name == 'suite': return os.path.join(settings.SUITES_PATH, "{}.zip".format(self.ts_id))
+		elif name == 'wheels': return os.path.join(wheelhouse.staging_path, self.container_name)
 		else: raise NotImplemented
 
+	def volume_path(self, name):
+		# Where the host sees files the container wrote to a volume
+		if hasattr(self.container, 'volume_path'):
+			return self.container.volume_path(self.path_in_container(name))
+		return self.path_in_host(name)
+
 	def path_in_container(self, name):
 		if name in ['agent', 'suite']: name = "{}.zip".format(name)
 		return os.path.join('/', self.container_name, name)
 
+	def check_image_size(self):
+		# Reject oversized images from their manifest, before downloading any layer
+		if not registry or image_cache.local(self.image):
+			return
+		size = registry.image_size(self.image)
+		if size is None:
+			self.log('No manifest available, image size is checked after pull')
+			return
+		self.log('Image size from manifest: {} KB'.format(size/1000))
+		if size/1000 > self.max_image_size:
+			raise MaxImageSizeExceeded(size/1000)
+
+	def hold_image(self, name):
+		# Not evicted before destroy(), and counted in the image cache budget
+		if image_cache and name not in self.held:
+			image_cache.use(name, holder=self.container_name)
+			self.held.append(name)
+
 	def pull_image(self):
 		self.log('Pulling image: {}'.format(self.image))
-		client.images.pull(self.image)
+		if image_cache:
+			self.held.append(self.image)
+			image_cache.pull(self.image, holder=self.container_name)
+		else:
+			client.images.pull(self.image)
+
+	@property
+	def can_bake(self):
+		return settings.Runner.USE_DOCKER and self.runner_type == RunnerType.Python and self.suite_hash is not None
+
+	@property
+	def baked_image(self):
+		key = hashlib.md5('|'.join([settings.Runner.PYTHON_DOCKER_IMAGE, runner_hash(), self.suite_hash]).encode('utf8')).hexdigest()
+		return '{}:{}'.format(settings.Runner.BAKED_IMAGE_REPOSITORY, key)
+
+	def use_baked_image(self):
+		# Image with runner-kit and the suite already installed, see bake()
+		if not self.can_bake:
+			return
+		self.hold_image(self.baked_image)
+		try:
+			client.images.get(self.baked_image)
+		except docker.errors.ImageNotFound:
+			return
+		self.log('Using baked image: {}'.format(self.baked_image))
+		self.image = self.baked_image
+		self.baked = True
+
+	def bake(self):
+		repository, tag = self.baked_image.split(':')
+		try:
+			self.container.commit(repository=repository, tag=tag, changes=self.image_labels('baked'))
+		except docker.errors.APIError as e:
+			self.log('Bake failed: {}'.format(e), log_type='error')
+			return
+		self.log('Baked image: {}'.format(self.baked_image))
+		self.hold_image(self.baked_image)
+		# Garbage collect images baked for previous versions of the suite, with the dependency layers built on them
+		for image in client.images.list(filters={'label': ['{}={}'.format(settings.Runner.BAKED_IMAGE_LABEL, self.ts_id),
+			'{}=baked'.format(settings.Runner.IMAGE_KIND_LABEL)]}):
+			if self.baked_image in image.tags:
+				continue
+			if image_cache.remove(image.tags[0] if image.tags else image.id):
+				self.log('Removed superseded baked image: {}'.format(image.tags))
+			else:
+				self.log('Could not remove superseded baked image: {}'.format(image.tags), log_type='warning')
+
+	def image_labels(self, kind):
+		# Commit changes, layers inherit the labels of the baked image they are built on and override the kind
+		return 'LABEL {}={} {}={}'.format(settings.Runner.BAKED_IMAGE_LABEL, self.ts_id, settings.Runner.IMAGE_KIND_LABEL, kind)
 
 	def run_container(self):
 		self.log('Running container image: {}'.format(self.image))
 		self.volumes = {
 			settings.RUNNER_PATH: {'bind': self.path_in_container('runner'), 'mode': 'ro'},
-			self.path_in_host('agent'): {'bind': self.path_in_container('agent'), 'mode': 'ro'},
 			self.path_in_host('suite'): {'bind': self.path_in_container('suite'), 'mode': 'ro'},
+			wheelhouse.staging(self.container_name): {'bind': self.path_in_container('wheels'), 'mode': 'rw'},
 		}
-		self.container = client.containers.create(self.image, volumes=self.volumes, stdin_open=True, name=self.container_name)
+		self.volumes.update(self.wheelhouse_volumes())
+		if self.agent_id is not None:
+			self.volumes[self.path_in_host('agent')] = {'bind': self.path_in_container('agent'), 'mode': 'ro'}
+		if self.is_clone:
+			self.container = self.base.container.clone(self.container_name, volumes=self.volumes, **self.limits)
+		else:
+			self.container = client.containers.create(self.image, volumes=self.volumes, stdin_open=True, name=self.container_name, **self.limits)
 		self.container.start()
 
-	def exec_run(self, command, exception=None, **kwargs):
+	def wheelhouse_volumes(self):
+		# Trusted dependency wheels and the artifacts this job installs, never the whole wheelhouse
+		volumes = {wheelhouse.deps_path: {'bind': '{}/deps'.format(self.path_in_container('wheelhouse')), 'mode': 'ro'}}
+		for name in SHARED_BUILDS:
+			key = self.artifact_key(name)
+			if key and wheelhouse.has(key):
+				volumes[wheelhouse.artifact_path(key)] = {'bind': '{}/artifacts/{}'.format(self.path_in_container('wheelhouse'), key), 'mode': 'ro'}
+				self.artifacts.add(key)
+		return volumes
+
+	@property
+	def is_clone(self):
+		# Sandboxes are cloned from the base one, Docker children start from its baked image instead
+		return self.base is not None and hasattr(self.base.container, 'clone')
+
+	@property
+	def limits(self):
+		# Docker container options, the virtualenv client maps them to firejail/rlimits
+		limits = {}
+		if self.cpus:
+			limits['cpuset_cpus'] = ','.join(str(cpu) for cpu in self.cpus)
+		if self.memory:
+			limits['mem_limit'] = limits['memswap_limit'] = self.memory * 1024 * 1024 # no swap on top
+		return limits
+
+	def exec_stream(self, command, **kwargs):
+		# Yields (stdout, stderr) chunks as they come and returns the exit code
+		if self.killed:
+			raise utils.TimeoutException('Container was killed, not running: {}'.format(command))
+		if settings.Runner.USE_DOCKER:
+			exec_id = client.api.exec_create(self.container.id, command, **kwargs)['Id']
+			yield from client.api.exec_start(exec_id, stream=True, demux=True)
+			# The stream may end before the daemon has the exit code, an unknown one is a failure
+			waited = time.monotonic() + settings.Runner.EXEC_EXIT_TIMEOUT
+			info = client.api.exec_inspect(exec_id)
+			while info['Running'] and time.monotonic() < waited:
+				time.sleep(0.1)
+				info = client.api.exec_inspect(exec_id)
+			if info['Running'] or info['ExitCode'] is None:
+				self.log('No exit code for: {}'.format(command), log_type='warning')
+				return 1
+			return info['ExitCode']
+		return (yield from self.container.exec_stream(command))
+
+	def exec_run(self, command, exception=None, result=False, **kwargs):
+		# Output goes to the job log as it streams, only bounded tails are kept in memory:
+		# stdout and stderr for error messages, and stdout alone for result commands (the JSON result)
 		self.log('Running command: {}'.format(command))
-		exit_code, output = self.container.exec_run(command, **kwargs)
-		output = output.decode('utf8')
-		if exit_code > 0 and exception:
+		errors = utils.Tail(settings.Runner.ERROR_TAIL_SIZE * 1000)
+		results = utils.Tail(settings.Runner.RESULT_MAX_SIZE * 1000) if result else None
+		if self.job_log is None:
+			self.job_log = utils.CappedLog(self.log_path, settings.Runner.LOG_MAX_SIZE * 1000)
+		self.job_log.write('$ {}\n'.format(command).encode('utf8'))
+		size = 0
+		stream = self.exec_stream(command, **kwargs)
+		while True:
+			try:
+				stdout, stderr = next(stream)
+			except StopIteration as e:
+				exit_code = e.value
+				break
+			for data in [stdout, stderr]:
+				if data:
+					size += len(data)
+					self.job_log.write(data)
+					errors.write(data)
+			if results and stdout:
+				results.write(stdout)
+		self.job_log.flush()
+		if self.killed:
+			# Killed while it ran, whatever it left behind is partial
+			raise utils.TimeoutException('Container was killed while running: {}'.format(command))
+		output = errors.getvalue().decode('utf8', errors='replace')
+		if exit_code != 0 and exception:
 			raise exception(output)
-		self.log('\n{}'.format(output))
+		self.log('Command exited with {} ({} bytes of output in {})'.format(exit_code, size, self.log_path))
+		if results:
+			output = results.getvalue().decode('utf8', errors='replace')
 		return exit_code, output
 
-	def pip_install(self, items, r=False, exception=None, **kwargs):
-		return self.exec_run("pip install{} {}".format(' -r' if r else '', items), exception, **kwargs)
+	@property
+	def log_path(self):
+		return os.path.join(settings.LOG_PATH, str(self.ts_id), "{}.log".format(self.agent_id if self.agent_id is not None else 'batch'))
+
+	def pip_install(self, items, r=False, exception=None, no_deps=False, **kwargs):
+		return self.exec_run("pip install{}{} {}".format(' --no-deps' if no_deps else '', ' -r' if r else '', items), exception, **kwargs)
+
+	def artifact_key(self, name):
+		# Wheels depend on the interpreter, so keys are per image too
+		image_hash = hashlib.md5(self.image.encode('utf8')).hexdigest()[:8]
+		if name == 'runner': artifact_hash = runner_hash()
+		elif name == 'suite': artifact_hash = self.suite_hash
+		else: raise NotImplemented
+		if not artifact_hash:
+			return None
+		if self.runner_type == RunnerType.Docker:
+			image_hash += '-image' # built by the student's pip, never used by the Python runner
+		return '{}-{}-{}'.format(name, artifact_hash, image_hash)
+
+	def is_trusted_build(self, name):
+		# Runner-kit and suites built by the runner's own image, no student code has run in the container yet
+		return name in ['runner', 'suite'] and self.runner_type == RunnerType.Python
+
+	def wheel_hashes(self, key):
+		# sha256 of each built wheel as pip reports it, checked again when the wheels are committed
+		wheels = sorted(f for f in os.listdir(os.path.join(self.volume_path('wheels'), key)) if f.endswith('.whl'))
+		if not wheels:
+			return None
+		report = '{}/{}.report.json'.format(self.path_in_container('wheels'), key)
+		exit_code, _ = self.exec_run('pip install --dry-run --ignore-installed --no-deps --no-index --report {} {}'.format(
+			report, ' '.join('{}/{}/{}'.format(self.path_in_container('wheels'), key, wheel) for wheel in wheels)))
+		if exit_code != 0:
+			return None
+		try:
+			with open(os.path.join(self.volume_path('wheels'), '{}.report.json'.format(key))) as f:
+				installs = json.load(f)['install']
+		except (OSError, ValueError, KeyError) as e:
+			self.log('Unreadable build report of {}: {}'.format(key, e), log_type='warning')
+			return None
+		hashes = {}
+		for install in installs:
+			info = install.get('download_info', {})
+			hashes[unquote(info.get('url', '').split('/')[-1])] = info.get('archive_info', {}).get('hashes', {}).get('sha256')
+		return hashes
+
+	def cached_install(self, name, exception=None, offline=False, no_deps=False):
+		# Install from the wheelhouse when possible, building and committing the wheels on a miss
+		with self.timings.phase('{}_install'.format(name)):
+			return self._cached_install(name, exception, offline, no_deps)
+
+	def _cached_install(self, name, exception=None, offline=False, no_deps=False):
+		if name not in SHARED_BUILDS:
+			# A student's own code, built inside the job's container and never cached where other jobs can read it
+			return self.pip_install('{}--find-links {}/deps {}'.format('--no-index ' if offline else '', self.path_in_container('wheelhouse'),
+				self.path_in_container(name)), exception=exception, no_deps=no_deps)
+		key = self.artifact_key(name)
+		if not key:
+			return self.pip_install(self.path_in_container(name), exception=exception, no_deps=no_deps)
+		if key in self.artifacts:
+			self.log('Wheelhouse hit: {}'.format(key))
+			wheelhouse.touch(key)
+			artifact = '{}/artifacts/{}'.format(self.path_in_container('wheelhouse'), key)
+		else:
+			# Built in the job's staging dir and installed from there, a copy is committed for later jobs
+			self.log('Wheelhouse miss: {}'.format(key))
+			artifact = '{}/{}'.format(self.path_in_container('wheels'), key)
+			exit_code, _ = self.exec_run('pip wheel{}{} --find-links {}/deps -w {} {}'.format(
+				' --no-index' if offline else '', ' --no-deps' if no_deps else '', self.path_in_container('wheelhouse'), artifact, self.path_in_container(name)))
+			if exit_code != 0:
+				return self.pip_install(self.path_in_container(name), exception=exception, no_deps=no_deps)
+			hashes = self.wheel_hashes(key) if self.is_trusted_build(name) else None
+			if not wheelhouse.commit(key, os.path.join(self.volume_path('wheels'), key), hashes=hashes):
+				return self.pip_install(self.path_in_container(name), exception=exception, no_deps=no_deps)
+		exit_code, output = self.pip_install('--no-index --find-links {0} -r {0}/requirements.txt'.format(artifact), no_deps=no_deps)
+		if exit_code != 0:
+			return self.pip_install(self.path_in_container(name), exception=exception, no_deps=no_deps)
+		return exit_code, output
+
+	def layer_key(self):
+		# Agents declaring the same dependencies share a layer, per base environment
+		requirements = layers.read_requirements(self.path_in_host('agent'))
+		if not requirements:
+			return None
+		if settings.Runner.USE_DOCKER:
+			# Committed on top of the baked image, so a layer never carries another suite
+			return layers.requirements_key(requirements, self.baked_image) if self.can_bake else None
+		return layers.requirements_key(requirements, 'python-{}'.format(self.container.image))
+
+	def layer_image(self, key):
+		return '{}:layer-{}'.format(settings.Runner.BAKED_IMAGE_REPOSITORY, key)
+
+	def use_layer_image(self):
+		# Baked image with the agent's dependencies installed too, see install_layer()
+		if not (settings.Runner.USE_DOCKER and self.baked and self.runner_type == RunnerType.Python):
+			return
+		key = self.layer_key()
+		if not key:
+			return
+		self.hold_image(self.layer_image(key))
+		try:
+			client.images.get(self.layer_image(key))
+		except docker.errors.ImageNotFound:
+			return
+		self.log('Using dependency layer: {}'.format(self.layer_image(key)))
+		self.image = self.layer_image(key)
+		self.layered = True
+
+	def build_layer(self, key, target=None):
+		# Wheels only, no dependency code runs while the network is up
+		requirements = layers.read_requirements(self.path_in_host('agent'))
+		with open(os.path.join(self.volume_path('wheels'), 'layer-{}.txt'.format(key)), 'w') as f:
+			f.write('\n'.join(requirements) + '\n')
+		exit_code, _ = self.exec_run('pip install --only-binary :all: --find-links {}/deps{} -r {}/layer-{}.txt'.format(
+			self.path_in_container('wheelhouse'), ' --target {}'.format(target) if target else '', self.path_in_container('wheels'), key))
+		return exit_code == 0
+
+	def install_layer(self):
+		# Agent dependencies, installed once per requirements key instead of once per agent
+		if self.layered:
+			return
+		key = self.layer_key()
+		if not key:
+			return
+		with self.timings.phase('layer'):
+			if settings.Runner.USE_DOCKER:
+				self.log('Building dependency layer: {}'.format(self.layer_image(key)))
+				if not self.build_layer(key):
+					return
+				repository, tag = self.layer_image(key).split(':')
+				try:
+					self.container.commit(repository=repository, tag=tag, changes=self.image_labels('layer'))
+				except docker.errors.APIError as e:
+					self.log('Layer commit failed: {}'.format(e), log_type='error')
+				else:
+					self.hold_image(self.layer_image(key))
+			elif dependency_layers and hasattr(self.container, 'attach'):
+				if dependency_layers.has(key):
+					self.log('Dependency layer hit: {}'.format(key))
+					dependency_layers.touch(key)
+				else:
+					self.log('Building dependency layer: {}'.format(key))
+					target = '{}/layer-{}'.format(self.path_in_container('wheels'), key)
+					if not self.build_layer(key, target=target):
+						return
+					dependency_layers.commit(key, os.path.join(self.volume_path('wheels'), 'layer-{}'.format(key)))
+				self.container.attach(dependency_layers.layer_path(key))
+			else:
+				return
+		self.layered = True
 
 	def connect(self, network_name='bridge'):
 		client.networks.list(names=[network_name])[0].connect(self.container)
@@ -145,36 +502,22 @@ class Runnable(object):
 		self.log('Running container: TS.{}, A.{}, RT.{}, RTL.{}'.format(self.ts_id, self.agent_id, self.runner_type, self.run_time_limit))
 		output = (None, None) # (error, data)
 		try:
-			with utils.time_limit(self.pull_time_limit, 'Image pull time limit exceeded'):
-				self.pull_image()
-				if client.images.get(self.image).attrs['Size']/1000 > self.max_image_size:
-					raise MaxImageSizeExceeded()
-
-				if not self.container:
-					self.run_container()
+			with deadline.limit(self.pull_time_limit, 'Image pull time limit exceeded', on_expire=self.abort, name=self.deadline_name('pull')) as d:
+				self.create(d)
 
-			with utils.time_limit(self.setup_time_limit, 'Setup time limit exceeded'):
-				# Install
-				self.pip_install(self.path_in_container('runner'), exception=RunnerInstallError)
+			with deadline.limit(self.setup_time_limit, 'Setup time limit exceeded', on_expire=self.abort, name=self.deadline_name('setup')):
+				self.install_base()
 				if self.runner_type == RunnerType.Python:
+					self.install_layer()
 					self.disconnect()
-					self.pip_install(self.path_in_container('agent'), exception=AgentInstallError)
+					self.cached_install('agent', exception=AgentInstallError, offline=True, no_deps=self.layered)
 					self.connect()
-				self.pip_install(self.path_in_container('suite'), exception=SuiteInstallError)
 
-			with utils.time_limit(self.run_time_limit, 'Run time limit exceeded'):
+			with deadline.limit(self.run_time_limit, 'Run time limit exceeded', on_expire=self.abort, name=self.deadline_name('run')):
 				# Execute runner
-				exit_code, output = self.exec_run("runner", exception=RunnerError)
-				try:
-					data = json.loads(output)
-				except json.JSONDecodeError as e:
-					raise MalformedOutputError(str(e), output)
-
-				# Save output for the future
-				os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
-				with open(self.output_path, 'w') as outfile:
-					json.dump(data, outfile)
-
+				with self.timings.phase('runner'):
+					exit_code, output = self.exec_run("runner", exception=RunnerError, result=True)
+				data = parse_result(output)
 				output = (None, data)
 
 			if interactive:
@@ -185,25 +528,136 @@ class Runnable(object):
 			self.log(message, log_type='error')
 			output = (e, None)
 		finally:
-			self.destroy()
+			with self.timings.phase('teardown'):
+				self.destroy()
+			if self.record:
+				self.save(output)
 			return output
 
+	def save(self, output):
+		# Save output for the future
+		error, data = output
+		agent_hash = artifact_index.lookup(self.path_in_host('agent')) if self.runner_type == RunnerType.Python and self.agent_id is not None else None
+		try:
+			result_store.record(self.ts_id, self.agent_id, data=data, error=error, phases=self.timings.phases,
+				runner=self.runner_type, suite_hash=self.suite_hash, agent_hash=agent_hash)
+		except sqlite3.Error as e:
+			self.log('Result not recorded: {}'.format(e), log_type='error')
+
+	def create(self, d):
+		self.use_baked_image()
+		self.use_layer_image()
+		if self.is_clone:
+			self.baked = True # runner-kit and the suite come with the clone
+		with self.timings.phase('image_pull'):
+			if not self.baked:
+				self.check_image_size()
+				d.call(self.pull_image)
+			# The limit is on student images, baked images and dependency layers are built by the runner on top of its own
+			if self.runner_type == RunnerType.Docker or not (self.baked or self.layered):
+				if client.images.get(self.image).attrs['Size']/1000 > self.max_image_size:
+					raise MaxImageSizeExceeded()
+
+		if not self.container:
+			with self.timings.phase('container_create'):
+				self.run_container()
+
+	def install_base(self):
+		# Install (pooled sandboxes come with runner-kit, baked images and clones with the suite too)
+		if not self.baked:
+			if not getattr(self.container, 'runner_installed', False):
+				self.cached_install('runner', exception=RunnerInstallError)
+			self.cached_install('suite', exception=SuiteInstallError)
+			if self.can_bake:
+				with self.timings.phase('bake'):
+					self.bake()
+
+	def prepare(self):
+		# Container with runner-kit and the suite but no agent, the base of a Batch
+		with deadline.limit(self.pull_time_limit, 'Image pull time limit exceeded', on_expire=self.abort, name=self.deadline_name('pull')) as d:
+			self.create(d)
+		with deadline.limit(self.setup_time_limit, 'Setup time limit exceeded', on_expire=self.abort, name=self.deadline_name('setup')):
+			self.install_base()
+
+	def deadline_name(self, phase):
+		return 'TS.{}-A.{}-{}'.format(self.ts_id, self.agent_id, phase)
+
+	def abort(self):
+		# Called from the deadline engine: stop whatever is still running in the container, and whatever would run next
+		self.log('Time limit exceeded, killing container', log_type='warning')
+		self.killed = True
+		if self.container:
+			try:
+				self.container.kill()
+			except Exception as e:
+				self.log('Kill failed: {}'.format(e), log_type='error')
+
 	def destroy(self):
 		self.log('Destroying container image: {}'.format(self.image))
 		if self.container:
-			self.container.kill()
-			self.container.remove()
-		if self.runner_type == RunnerType.Docker:
+			# Right away, the cores of the job may go to the next one
 			try:
-				client.images.get(self.image) # check image exists
-				client.images.delete(self.image)
-			except docker.errors.ImageNotFound:
-				pass
+				self.container.kill()
+			except Exception:
+				pass # already stopped, e.g. by abort()
+		if self.job_log:
+			self.job_log.close()
+		# Kept for resubmissions and re-grades until the cache runs out of budget
+		if self.reap:
+			reaper.put(self.container.name if self.container else None, self.container_name, self.held)
+			return
+		if self.container:
+			self.container.remove()
+		wheelhouse.discard(self.container_name)
+		for name in self.held:
+			image_cache.release(name, holder=self.container_name)
+
+
+class Batch(object):
+	"""
+	Evaluates many agents against one suite. Runner-kit and the suite are installed once into a base
+	environment, each agent then runs in its own child: a clone of the base sandbox (virtualenv) or
+	a container of the image baked from it (Docker). Every agent's result is recorded on its own.
+	Containers are named aiVLE-batch-<pid>-*, a watcher's reaper leaves them alone while this process lives.
+	"""
+	def __init__(self, ts_id, agent_ids, workers=settings.Runner.BATCH_WORKERS, **kwargs):
+		self.ts_id = ts_id
+		self.agent_ids = agent_ids
+		self.workers = workers
+		self.kwargs = kwargs
+		suite_path = os.path.join(settings.SUITES_PATH, '{}.zip'.format(ts_id))
+		if self.kwargs.get('suite_hash') is None and os.path.isfile(suite_path):
+			# Docker children start from the baked image, which is keyed by the suite hash
+			self.kwargs['suite_hash'] = artifact_index.hash(suite_path)
+
+	def run_agent(self, base, agent_id):
+		name = 'aiVLE-batch-{}-TS.{}-A.{}-{}'.format(os.getpid(), self.ts_id, agent_id, utils.generate_secure_string(16))
+		return Runnable(self.ts_id, agent_id, base=base, name=name, **self.kwargs).run()
+
+	def run(self):
+		# Returns agent id -> (error, data)
+		base = Runnable(self.ts_id, None, name='aiVLE-batch-{}-TS.{}-base-{}'.format(os.getpid(), self.ts_id, utils.generate_secure_string(16)), **self.kwargs)
+		outputs = {}
+		try:
+			base.prepare()
+			with ThreadPoolExecutor(max_workers=self.workers) as pool:
+				for agent_id, output in zip(self.agent_ids, pool.map(lambda agent_id: self.run_agent(base, agent_id), self.agent_ids)):
+					outputs[agent_id] = output
+		except Exception as e:
+			base.log('Batch setup failed: {!r}'.format(e), log_type='error')
+			outputs = {agent_id: outputs.get(agent_id, (e, None)) for agent_id in self.agent_ids}
+		finally:
+			base.destroy()
+		return outputs
 
 
 if __name__ == "__main__":
 	import sys
 	suite_id = sys.argv[1]
-	agent_id = sys.argv[2]
-	r = Runnable(suite_id, agent_id, name='test-{}-{}'.format(suite_id, agent_id))
-	r.run(interactive=True)
+	agent_ids = sys.argv[2:]
+	if len(agent_ids) > 1:
+		for agent_id, (error, data) in Batch(suite_id, agent_ids).run().items():
+			print(agent_id, error or data)
+	else:
+		r = Runnable(suite_id, agent_ids[0], name='test-{}-{}'.format(suite_id, agent_ids[0]))
+		r.run(interactive=True)
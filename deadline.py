@@ -0,0 +1,143 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+import logging
+from contextlib import contextmanager
+
+import utils
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class Deadline(object):
+    def __init__(self, seconds, message="Time limit exceeded", on_expire=None, name=None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.message = message
+        self.on_expire = on_expire
+        self.name = name
+        self.expired = False
+        self.cancelled = False
+
+    def remaining(self):
+        if self.expires_at is None:
+            return None # no limit
+        return max(0, self.expires_at - time.monotonic())
+
+    def check(self):
+        if self.expired:
+            raise utils.TimeoutException(self.message)
+
+    def call(self, func, *args, **kwargs):
+        # For blocking calls that on_expire cannot interrupt (e.g. image pulls),
+        # run them aside and give up waiting once the budget is spent
+        result = {}
+        def target():
+            try:
+                result['value'] = func(*args, **kwargs)
+            except BaseException as e:
+                result['error'] = e
+        thread = threading.Thread(target=target, name='deadline-call-{}'.format(self.name), daemon=True)
+        thread.start()
+        thread.join(self.remaining())
+        if thread.is_alive():
+            engine.expire(self)
+            raise utils.TimeoutException(self.message)
+        if 'error' in result:
+            raise result['error']
+        return result.get('value')
+
+    def __repr__(self):
+        return '<Deadline {} {}s left>'.format(self.name, self.remaining())
+
+
+class DeadlineEngine(object):
+    """
+    Tracks the deadlines of every active job in this process with a single timer thread.
+    Unlike SIGALRM, any number of deadlines can be active at once and from any thread.
+    """
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name='deadline-engine', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                timeout = self._heap[0][0] - time.monotonic()
+                if timeout > 0:
+                    self._cond.wait(timeout)
+                    continue
+                _, _, deadline = heapq.heappop(self._heap)
+            self.expire(deadline)
+
+    def add(self, deadline):
+        # Threads and locks do not survive fork, start afresh in child processes
+        if self._pid != os.getpid():
+            self._reset()
+        with self._cond:
+            self._ensure_thread()
+            heapq.heappush(self._heap, (deadline.expires_at, next(self._counter), deadline))
+            self._cond.notify()
+
+    def cancel(self, deadline):
+        with self._cond:
+            deadline.cancelled = True
+            self._cond.notify()
+
+    def expire(self, deadline):
+        with self._cond:
+            if deadline.cancelled or deadline.expired:
+                return
+            deadline.expired = True
+        logger.info('Deadline expired: {} ({})'.format(deadline.name, deadline.message))
+        if deadline.on_expire:
+            try:
+                deadline.on_expire()
+            except Exception as e:
+                logger.error('Deadline {} expiry handler failed: {}'.format(deadline.name, e))
+
+    def active(self):
+        with self._cond:
+            return [d for _, _, d in self._heap if not d.cancelled and not d.expired]
+
+    @contextmanager
+    def limit(self, seconds, message="Time limit exceeded", on_expire=None, name=None):
+        if not seconds:
+            yield Deadline(None, message, name=name)
+            return
+        deadline = Deadline(seconds, message, on_expire=on_expire, name=name)
+        self.add(deadline)
+        try:
+            yield deadline
+        except Exception:
+            # Errors caused by on_expire killing the work are reported as the timeout
+            deadline.check()
+            raise
+        finally:
+            self.cancel(deadline)
+        deadline.check()
+
+
+engine = DeadlineEngine()
+limit = engine.limit
@@ -1,74 +1,109 @@
 import settings
 
-import shutil
 import os
-import requests
+import sys
+import time
 import logging
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from api import API
+from artifacts import ArtifactIndex
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 
 
-class BaseAPI(object):
-    def __init__(self, auth=None, verify=False):
-        self.session = requests.Session()
-        self.session.auth = auth
-        self.verify = verify
-        
-    def request(self, url, method='get', **kwargs):
-        assert method in ['get', 'post', 'delete', 'put']
-        response = getattr(self.session, method)(url, verify=self.verify, **kwargs)
-        return response
-        
-    def download(self, url, filepath):
-        response = self.session.get(url, stream=True)
-        with open(filepath, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        return response
-        
-class API(BaseAPI):
-    def __init__(self, base_url, auth=None):
-        super().__init__(auth=auth)
-        self.base_url = base_url
-        self.base = super()
-        
-    def request(self, id=None, action=None, method='get', **kwargs):
-        assert method in ['get', 'post', 'delete', 'put']
-        url = self.base_url
-        if id: url += str(id) + '/'
-        if action: url += format(action) + '/'
-        return super().request(url, method=method, **kwargs)
-
-# ---
-
-api = API(settings.Submission.API, (settings.Watcher.USERNAME, settings.Watcher.PASSWORD))
-
 def agent_path(submission_id):
     return os.path.join(settings.AGENTS_PATH, "{}.zip".format(submission_id))
 
-def maybe_download_agent(submission):
-    path = agent_path(submission['id'])
-    if not os.path.isfile(path):
-        logger.info('Agent not found, downloading...')
-        print(submission['file_url'], path)
-        response = api.download(submission['file_url'], path)
+
+class Mirror(object):
+    """
+    Mirrors every agent of the paginated Submission API into AGENTS_PATH.
+    The next page is fetched while the current one downloads, with at most `workers` downloads at once.
+    """
+    def __init__(self, api, workers=settings.Submission.WORKERS, index=None):
+        self.api = api
+        self.workers = workers
+        self.index = index or ArtifactIndex()
+        self.lock = threading.Lock()
+        self.stats = {'downloaded': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        self.start = None
+
+    def is_current(self, submission, path):
+        if not os.path.isfile(path):
+            return False
+        size, file_hash = submission.get('file_size'), submission.get('file_hash')
+        if size is not None and os.path.getsize(path) != size:
+            return False
+        if file_hash is not None and self.index.hash(path) != file_hash:
+            return False
+        return True
+
+    def maybe_download_agent(self, submission):
+        path = agent_path(submission['id'])
+        if self.is_current(submission, path):
+            self.count('skipped')
+            return
+        try:
+            response = self.api.download(submission['file_url'], path, expected_hash=submission.get('file_hash'))
+            if not response.ok:
+                raise Exception('Agent download failed', response.status_code)
+        except Exception as e:
+            logger.error('Agent {}: {}'.format(submission['id'], e))
+            self.count('failed')
+            return
+        self.index.record(path, response.file_hash)
+        self.index.dedupe(path, response.file_hash)
+        self.count('downloaded', os.path.getsize(path))
+
+    def count(self, key, size=0):
+        with self.lock:
+            self.stats[key] += 1
+            self.stats['bytes'] += size
+            done = self.stats['downloaded'] + self.stats['skipped'] + self.stats['failed']
+        if done % settings.Submission.PROGRESS_EVERY == 0:
+            self.report()
+
+    def report(self):
+        elapsed = time.time() - self.start
+        with self.lock:
+            stats = dict(self.stats)
+        logger.info('{downloaded} downloaded, {skipped} skipped, {failed} failed, {mb:.1f} MB in {elapsed:.0f}s ({rate:.2f} MB/s)'.format(
+            mb=stats['bytes'] / 1e6, elapsed=elapsed, rate=stats['bytes'] / 1e6 / elapsed if elapsed else 0, **stats))
+
+    def fetch_page(self, url):
+        response = self.api.base.request(url)
         if response.status_code != 200:
-            raise Exception('Agent download failed', response.status_code)
-        return
-    logger.info('Agent already exists, skipped.')
-
-next_url = settings.Submission.API
-while next_url is not None:
-    print(next_url)
-    response = api.base.request(next_url)
-    if response.status_code != 200:
-        raise Exception('Traversal failed:', next_url, response.status_code)
-    submissions = response.json()
-    next_url = submissions['next']
-    for submission in submissions['results']:
-        # print(submission)
-        maybe_download_agent(submission)
+            raise Exception('Traversal failed:', url, response.status_code)
+        return response.json()
+
+    def run(self, url=settings.Submission.API):
+        self.start = time.time()
+        # Bound the queued downloads so pages are not fetched far ahead of them
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        def download(submission):
+            try:
+                self.maybe_download_agent(submission)
+            finally:
+                slots.release()
+        with ThreadPoolExecutor(max_workers=1) as pages, ThreadPoolExecutor(max_workers=self.workers) as downloads:
+            next_page = pages.submit(self.fetch_page, url)
+            while next_page is not None:
+                submissions = next_page.result()
+                next_page = pages.submit(self.fetch_page, submissions['next']) if submissions['next'] else None
+                for submission in submissions['results']:
+                    slots.acquire()
+                    downloads.submit(download, submission)
+        self.report()
+        return self.stats
+
+
+def mirror(url=settings.Submission.API, workers=settings.Submission.WORKERS):
+    api = API(settings.Submission.API, (settings.Watcher.USERNAME, settings.Watcher.PASSWORD))
+    return Mirror(api, workers=workers).run(url)
+
+
+if __name__ == "__main__":
+    mirror(workers=int(sys.argv[1]) if len(sys.argv) > 1 else settings.Submission.WORKERS)
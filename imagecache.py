@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import fcntl
+import hashlib
+import logging
+from contextlib import contextmanager
+
+import docker
+
+import settings
+from api import file_lock
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class ImageCache(object):
+    """
+    Keeps pulled images around up to a total size budget, evicting the least recently used.
+    Images built here (baked images and dependency layers) count towards the budget too, from their first use.
+    State (last use and holders per image, hit/miss stats) is a JSON file shared by all worker processes.
+    Images held by a job, from its pull or use until its release, are never evicted.
+    """
+    def __init__(self, client, max_size=settings.ImageCache.MAX_SIZE, pinned=settings.ImageCache.PINNED,
+        state_path=settings.ImageCache.STATE_PATH, hold_time=settings.ImageCache.HOLD_TIME):
+        self.client = client
+        self.max_size = max_size
+        self.pinned = set(pinned)
+        self.state_path = state_path
+        self.hold_time = hold_time
+
+    @contextmanager
+    def state(self):
+        with open(self.state_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                state = {'images': {}, 'stats': {'hits': 0, 'misses': 0, 'pull_seconds': 0, 'evictions': 0}}
+            yield state
+            tmp_path = self.state_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+
+    def local(self, name):
+        try:
+            return self.client.images.get(name)
+        except docker.errors.ImageNotFound:
+            return None
+
+    def is_current(self, name, image):
+        try:
+            digest = self.client.images.get_registry_data(name).id
+        except docker.errors.APIError:
+            return True # registry unreachable or image not in a registry, the local copy is all we have
+        return any(repo_digest.endswith(digest) for repo_digest in image.attrs.get('RepoDigests', []))
+
+    def is_held(self, info, now):
+        return any(now - held < self.hold_time for held in info.get('holders', {}).values())
+
+    def use(self, name, holder=None):
+        # holder: the job using the image, held until release(name, holder)
+        with self.state() as state:
+            info = state['images'].setdefault(name, {})
+            info['last_used'] = time.time()
+            if holder:
+                info.setdefault('holders', {})[holder] = time.time()
+
+    def pull(self, name, holder=None):
+        # Held from before the pull. One pull per image at a time across processes, the others wait and hit.
+        self.use(name, holder)
+        with file_lock('{}.{}.pull.lock'.format(self.state_path, hashlib.md5(name.encode('utf8')).hexdigest())):
+            image = self.local(name)
+            hit = image is not None and self.is_current(name, image)
+            start = time.time()
+            if not hit:
+                self.client.images.pull(name)
+        with self.state() as state:
+            state['images'].setdefault(name, {})['last_used'] = time.time()
+            if hit:
+                state['stats']['hits'] += 1
+            else:
+                state['stats']['misses'] += 1
+                state['stats']['pull_seconds'] += time.time() - start
+        logger.info('Image cache {}: {} {}'.format('hit' if hit else 'miss', name, self.stats()))
+
+    def release(self, name, holder=None):
+        with self.state() as state:
+            if name in state['images']:
+                state['images'][name]['last_used'] = time.time()
+                state['images'][name].get('holders', {}).pop(holder, None)
+        self.evict()
+
+    def own_size(self, image):
+        # KB, committed images share the layers of their parent
+        size = image.attrs['Size']
+        if image.attrs.get('Parent'):
+            parent = self.local(image.attrs['Parent'])
+            if parent is not None:
+                size -= parent.attrs['Size']
+        return size / 1000
+
+    def children(self, image):
+        # Dependency layers committed on top of the image, Docker keeps a parent while they exist
+        return [child for child in self.client.images.list(filters={'label': '{}=layer'.format(settings.Runner.IMAGE_KIND_LABEL)})
+            if child.attrs.get('Parent') == image.id]
+
+    def _remove(self, name, state, now):
+        # Children first, nothing is removed while any of them is held. Returns the names removed, None if it could not be.
+        image = self.local(name)
+        if image is None:
+            state['images'].pop(name, None)
+            return [name]
+        removed = []
+        for child in self.children(image):
+            child_name = child.tags[0] if child.tags else child.id
+            if child_name in self.pinned or self.is_held(state['images'].get(child_name, {}), now):
+                logger.info('Image cache: {} is held, keeping {}'.format(child_name, name))
+                return None
+            child_removed = self._remove(child_name, state, now)
+            if child_removed is None:
+                return None
+            removed += child_removed
+        try:
+            self.client.images.remove(name)
+        except docker.errors.APIError as e:
+            logger.info('Image cache: cannot remove {} ({})'.format(name, e)) # e.g. still in use
+            return None
+        logger.info('Image cache: removed {}'.format(name))
+        state['images'].pop(name, None)
+        state['stats']['evictions'] += 1
+        return removed + [name]
+
+    def remove(self, name):
+        # Unless pinned or held, along with the layers built on it
+        with self.state() as state:
+            now = time.time()
+            if name in self.pinned or self.is_held(state['images'].get(name, {}), now):
+                return False
+            return self._remove(name, state, now) is not None
+
+    def last_used(self, name):
+        # Unix time, None if the cache has not seen the image used
+        with self.state() as state:
+            return state['images'].get(name, {}).get('last_used')
+
+    def evict(self):
+        with self.state() as state:
+            entries = []
+            sizes = {}
+            now = time.time()
+            for name, info in list(state['images'].items()):
+                image = self.local(name)
+                if image is None:
+                    if not self.is_held(info, now):
+                        del state['images'][name] # removed outside of the cache
+                    continue # or still being pulled
+                sizes[name] = self.own_size(image)
+                entries.append((info.get('last_used', 0), name))
+            total = sum(sizes.values())
+            for _, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                if name not in state['images'] or name in self.pinned or self.is_held(state['images'][name], now):
+                    continue # removed along with its parent, pinned or held
+                removed = self._remove(name, state, now)
+                for removed_name in removed or []:
+                    total -= sizes.get(removed_name, 0)
+
+    def stats(self):
+        with self.state() as state:
+            stats = dict(state['stats'])
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0
+        stats['saved_seconds'] = stats['hits'] * stats['pull_seconds'] / stats['misses'] if stats['misses'] else 0
+        return stats
@@ -0,0 +1,115 @@
+import os
+import re
+import ast
+import shutil
+import hashlib
+import logging
+import zipfile
+import configparser
+
+import settings
+import utils
+from wheelhouse import publish, evict
+
+try:
+    import tomllib
+except ImportError: # Python < 3.11, pyproject.toml dependencies are not read
+    tomllib = None
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+# Plain PEP 508 requirements only, local paths and direct references cannot be shared
+REQUIREMENT = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]*(\[[A-Za-z0-9._, -]*\])?\s*([<>=!~;(][^@/\\]*)?$')
+
+
+def setup_py_requirements(source):
+    # Literal install_requires of the setup() call, anything computed is ignored
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Call):
+            for keyword in node.keywords:
+                if keyword.arg == 'install_requires':
+                    try:
+                        return list(ast.literal_eval(keyword.value))
+                    except ValueError:
+                        return None
+    return []
+
+def setup_cfg_requirements(source):
+    parser = configparser.ConfigParser()
+    parser.read_string(source)
+    value = parser.get('options', 'install_requires', fallback='')
+    return [line for line in value.splitlines() if line.strip()]
+
+def pyproject_requirements(source):
+    if tomllib is None:
+        return None
+    return tomllib.loads(source).get('project', {}).get('dependencies', [])
+
+PARSERS = [('setup.py', setup_py_requirements), ('setup.cfg', setup_cfg_requirements), ('pyproject.toml', pyproject_requirements)]
+
+
+def read_requirements(path):
+    """
+    Dependencies declared by an agent package (zip), what pip installs along with it.
+    None when there are none or when they cannot be shared (local paths, computed lists).
+    """
+    try:
+        with zipfile.ZipFile(path) as package:
+            names = package.namelist()
+            requirements = []
+            for filename, parse in PARSERS:
+                # The project root is the zip root or its only top-level folder
+                matches = sorted((name for name in names if name.split('/')[-1] == filename and name.count('/') <= 1), key=len)
+                if not matches:
+                    continue
+                found = parse(package.read(matches[0]).decode('utf8'))
+                if found is None:
+                    return None
+                requirements += found
+    except (OSError, zipfile.BadZipFile, SyntaxError, ValueError, configparser.Error, UnicodeDecodeError) as e:
+        logger.info('Requirements of {} not readable: {}'.format(path, e))
+        return None
+    requirements = sorted(set(' '.join(str(r).split()).lower() for r in requirements))
+    if not requirements or not all(REQUIREMENT.match(r) for r in requirements):
+        return None
+    return requirements
+
+def requirements_key(requirements, image):
+    return hashlib.md5('|'.join([image] + requirements).encode('utf8')).hexdigest()
+
+
+class Layers(object):
+    """
+    Host-side store of pre-installed agent dependencies, one read-only site-packages dir per
+    requirements key, shared by sandboxes (Docker layers are images, see core.Runnable.install_layer).
+    """
+    def __init__(self, path=settings.Layers.PATH, max_size=settings.Layers.MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def layer_path(self, key):
+        return os.path.join(self.path, key)
+
+    def has(self, key):
+        return os.path.isdir(self.layer_path(key))
+
+    def touch(self, key):
+        try:
+            os.utime(self.layer_path(key))
+        except FileNotFoundError:
+            pass
+
+    def commit(self, key, build_path):
+        tmp_path = os.path.join(self.path, '.{}-{}'.format(key, utils.generate_secure_string(8)))
+        shutil.copytree(build_path, tmp_path, symlinks=True)
+        publish(tmp_path, self.layer_path(key))
+        logger.info('Layers: committed {}'.format(key))
+        self.evict()
+
+    def evict(self):
+        # Layers are touched when attached
+        evict([self.layer_path(name) for name in os.listdir(self.path) if not name.startswith('.')], self.max_size, 'Layers')
@@ -0,0 +1,66 @@
+import json
+import time
+import hashlib
+import logging
+
+import settings
+import utils
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class ResultCache(object):
+    """
+    Results of past runs, keyed by everything that determines them: suite hash, agent hash or
+    image digest, runner-kit version, runner type and limits. Only successful runs are stored.
+    Hits and misses are counted in the same database, across worker processes.
+    """
+    def __init__(self, path=settings.ResultCache.PATH):
+        self.path = path
+        with utils.connect(self.path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY, task TEXT, suite_hash TEXT, runner_hash TEXT, data TEXT, created REAL, hits INTEGER DEFAULT 0)''')
+            db.execute('CREATE INDEX IF NOT EXISTS results_task ON results (task)')
+            db.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def key(self, **parts):
+        return hashlib.md5(json.dumps(parts, sort_keys=True).encode('utf8')).hexdigest()
+
+    def invalidate(self, task, suite_hash, runner_hash):
+        # Entries of an older suite or runner-kit can never hit again
+        with utils.connect(self.path) as db:
+            removed = db.execute('DELETE FROM results WHERE runner_hash!=? OR (task=? AND suite_hash!=?)',
+                (runner_hash, str(task), suite_hash)).rowcount
+        if removed:
+            logger.info('Result cache: invalidated {} entries'.format(removed))
+
+    def get(self, key):
+        with utils.connect(self.path) as db:
+            row = db.execute('SELECT data FROM results WHERE key=?', (key,)).fetchone()
+            if row:
+                db.execute('UPDATE results SET hits=hits+1 WHERE key=?', (key,))
+            name = 'hits' if row else 'misses'
+            db.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+            db.execute('UPDATE stats SET value=value+1 WHERE name=?', (name,))
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, task, suite_hash, runner_hash, data):
+        with utils.connect(self.path) as db:
+            db.execute('INSERT OR REPLACE INTO results (key, task, suite_hash, runner_hash, data, created) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, str(task), suite_hash, runner_hash, json.dumps(data), time.time()))
+
+    def stats(self):
+        with utils.connect(self.path) as db:
+            stats = dict(db.execute('SELECT name, value FROM stats').fetchall())
+            stats['entries'] = db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        stats.update(hits=hits, misses=misses, hit_rate=hits / (hits + misses) if hits + misses else 0)
+        return stats
+
+
+if __name__ == "__main__":
+    print(json.dumps(ResultCache().stats(), indent=2))
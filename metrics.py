@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import settings
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, float('inf')] # seconds
+
+
+class Timings(object):
+    # Seconds spent in each phase of one job
+    def __init__(self):
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def update(self, phases):
+        for name, seconds in phases.items():
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels)) + '}'
+
+
+class Registry(object):
+    """
+    Metrics of the watcher process. Workers send their job timings back with their results,
+    so everything is aggregated here and rendered in the Prometheus text format.
+    """
+    def __init__(self, slots=settings.Watcher.PROCESSES, log_path=settings.Metrics.LOG_PATH):
+        self.lock = threading.Lock()
+        self.log_path = log_path
+        self.histograms = {} # labels -> [bucket counts, sum, count]
+        self.counters = {}
+        self.gauges = {}
+        self.finished = deque() # job end times, last hour
+        self.slots = slots
+        self.busy = 0
+        self.busy_seconds = 0
+        self.busy_since = self.start = time.time()
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            key = (name, tuple(sorted(labels)))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels)))] = value
+
+    def observe(self, name, seconds, labels=()):
+        with self.lock:
+            key = (name, tuple(sorted(labels)))
+            buckets, total, count = self.histograms.get(key, ([0] * len(BUCKETS), 0, 0))
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            self.histograms[key] = (buckets, total + seconds, count + 1)
+
+    def set_busy(self, busy):
+        # Integrates busy slots over time for the utilization ratio
+        with self.lock:
+            now = time.time()
+            self.busy_seconds += self.busy * (now - self.busy_since)
+            self.busy, self.busy_since = busy, now
+
+    def observe_job(self, job, task, runner, phases, status, cache=None):
+        labels = (('task', task), ('runner', runner))
+        for phase, seconds in phases.items():
+            self.observe('aivle_runner_phase_seconds', seconds, labels + (('phase', phase),))
+        self.inc('aivle_runner_jobs_total', labels + (('status', status),))
+        if cache:
+            self.inc('aivle_runner_result_cache_total', (('result', cache),))
+        with self.lock:
+            self.finished.append(time.time())
+        # Per job record, job ids would be too many Prometheus series
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps({'time': time.time(), 'job': job, 'task': task, 'runner': runner, 'status': status, 'phases': phases, 'cache': cache}) + '\n')
+
+    def render(self):
+        self.set_busy(self.busy)
+        lines = []
+        with self.lock:
+            now = time.time()
+            while self.finished and self.finished[0] < now - 3600:
+                self.finished.popleft()
+            elapsed = min(now - self.start, 3600)
+            gauges = dict(self.gauges)
+            gauges[('aivle_runner_jobs_per_hour', ())] = len(self.finished) * 3600 / elapsed if elapsed else 0
+            gauges[('aivle_runner_slots', ())] = self.slots
+            gauges[('aivle_runner_slots_busy', ())] = self.busy
+            gauges[('aivle_runner_slot_utilization', ())] = self.busy_seconds / ((now - self.start) * self.slots) if now > self.start else 0
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            for (name, labels), value in sorted(gauges.items()):
+                lines.append('{}{} {}'.format(name, format_labels(labels), value))
+            for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                for bound, bucket in zip(BUCKETS, buckets):
+                    le = '+Inf' if bound == float('inf') else bound
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), bucket))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), total))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Exporter(object):
+    # Serves /metrics on PORT and/or rewrites FILE (for the node_exporter textfile collector)
+    def __init__(self, port=settings.Metrics.PORT, path=settings.Metrics.FILE, interval=settings.Metrics.INTERVAL):
+        self.port = port
+        self.path = path
+        self.interval = interval
+
+    def write(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(registry.render())
+        os.replace(tmp_path, self.path)
+
+    def loop(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logger.error('Metrics write failed: {}'.format(e))
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.port:
+            server = HTTPServer(('127.0.0.1', self.port), Handler)
+            threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+            logger.info('Metrics on http://127.0.0.1:{}/metrics'.format(self.port))
+        if self.path:
+            threading.Thread(target=self.loop, name='metrics-writer', daemon=True).start()
+
+
+registry = Registry()
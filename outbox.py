@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import fcntl
+import random
+import shutil
+import logging
+import threading
+
+import requests
+
+import settings
+import metrics
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+class Outbox(object):
+    """
+    On-disk journal of job results waiting to be posted, one JSON file per result.
+    Writing is atomic and fsynced, so a result survives a crash once put() returns.
+    """
+    def __init__(self, path=settings.Outbox.PATH):
+        self.path = path
+        self.failed_path = os.path.join(path, 'failed')
+        os.makedirs(self.failed_path, exist_ok=True)
+
+    def put(self, job_id, data):
+        name = '{}-{}.json'.format(time.time_ns(), job_id)
+        tmp_path = os.path.join(self.path, '.' + name)
+        with open(tmp_path, 'w') as f:
+            json.dump({'job': job_id, 'data': data}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, name))
+        # The rename itself is only durable once the directory is
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        logger.info('Result of job {} queued in outbox'.format(job_id))
+
+    def pending(self):
+        # Oldest first
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.json') and not name.startswith('.'))
+
+    def read(self, name):
+        with open(os.path.join(self.path, name)) as f:
+            return json.load(f)
+
+    def remove(self, name):
+        os.remove(os.path.join(self.path, name))
+
+    def fail(self, name):
+        shutil.move(os.path.join(self.path, name), os.path.join(self.failed_path, name))
+
+
+class Flusher(object):
+    """
+    Posts outbox entries in the background, with exponential backoff per entry.
+    Only one flusher per outbox is active at a time (file lock).
+    """
+    def __init__(self, api, outbox, interval=settings.Outbox.INTERVAL, max_delay=settings.Outbox.MAX_DELAY,
+        batch_action=settings.Outbox.BATCH_ACTION, batch_size=settings.Outbox.BATCH_SIZE):
+        self.api = api
+        self.outbox = outbox
+        self.interval = interval
+        self.max_delay = max_delay
+        self.batch_action = batch_action
+        self.batch_size = batch_size
+        self.retries = {} # name -> (attempts, next attempt time)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def due(self):
+        now = time.time()
+        return [name for name in self.outbox.pending() if self.retries.get(name, (0, 0))[1] <= now]
+
+    def succeeded(self, name):
+        # Time from queueing (encoded in the entry name) to acknowledgement by the API
+        metrics.registry.observe('aivle_runner_result_post_seconds', time.time() - int(name.split('-', 1)[0]) / 1e9)
+        self.outbox.remove(name)
+        self.retries.pop(name, None)
+
+    def failed(self, name, status):
+        if status is not None and 400 <= status < 500 and status not in (408, 429):
+            # Rejected by the server, retrying will not help
+            logger.error('Outbox: {} rejected ({}), moved to failed'.format(name, status))
+            metrics.registry.inc('aivle_runner_result_post_failures_total')
+            self.outbox.fail(name)
+            self.retries.pop(name, None)
+            return
+        attempts = self.retries.get(name, (0, 0))[0] + 1
+        delay = min(self.max_delay, self.interval * 2 ** attempts) * random.uniform(0.5, 1.5)
+        self.retries[name] = (attempts, time.time() + delay)
+        logger.error('Outbox: posting {} failed ({}), retry #{} in {:.0f}s'.format(name, status, attempts, delay))
+
+    def post(self, name):
+        entry = self.outbox.read(name)
+        try:
+            response = self.api.request(id=entry['job'], action='end', method='post', json=entry['data'])
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        if status == 200:
+            self.succeeded(name)
+        else:
+            self.failed(name, status)
+
+    def post_batch(self, names):
+        entries = []
+        for name in names:
+            entry = self.outbox.read(name)
+            entries.append(dict(entry['data'], id=entry['job']))
+        try:
+            response = self.api.request(action=self.batch_action, method='post', json=entries)
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        for name in names:
+            if status == 200:
+                self.succeeded(name)
+            else:
+                self.failed(name, status)
+
+    def flush(self):
+        due = self.due()
+        if self.batch_action:
+            for i in range(0, len(due), self.batch_size):
+                self.post_batch(due[i:i + self.batch_size])
+        else:
+            for name in due:
+                self.post(name)
+
+    def loop(self):
+        with open(os.path.join(self.outbox.path, '.lock'), 'w') as lock:
+            while not self.stopping.is_set():
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    self.stopping.wait(self.interval) # another flusher owns this outbox
+            else:
+                return
+            while not self.stopping.is_set():
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error('Outbox: flush failed: {}'.format(e))
+                self.stopping.wait(self.interval)
+            # Last attempt before exit, the rest waits on disk for the next start
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error('Outbox: flush failed: {}'.format(e))
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name='outbox-flusher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
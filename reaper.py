@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import calendar
+import logging
+import threading
+
+import settings
+import metrics
+
+if settings.Runner.USE_DOCKER:
+    import docker
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+JOB_PREFIX = 'aiVLE-runner-'
+POOL_PREFIX = 'aiVLE-pool-'
+BATCH_PREFIX = 'aiVLE-batch-' # core.Batch, run from the command line beside the watcher, followed by its pid
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # someone else's
+    return True
+
+def created(container):
+    # Unix time, sandboxes by their directory and Docker containers by their creation date
+    if hasattr(container, 'path'):
+        return os.path.getmtime(container.path)
+    return calendar.timegm(time.strptime(container.attrs['Created'][:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+class Reaper(object):
+    """
+    Removes finished containers in the background, so a job slot does not wait for it.
+    Teardown requests are files in `path`: worker processes write them, the reaper thread of the
+    watcher works through them one at a time, pausing in between to keep its I/O away from running jobs.
+    On start it sweeps what a crash left behind: containers and sandboxes named like ours, and baked images
+    and dependency layers no job has used for `image_max_age`.
+    """
+    def __init__(self, client, wheelhouse, image_cache=None, path=settings.Reaper.PATH, pause=settings.Reaper.PAUSE,
+        interval=settings.Reaper.INTERVAL, max_age=settings.Reaper.MAX_AGE, image_max_age=settings.Reaper.IMAGE_MAX_AGE,
+        exclusive=settings.Reaper.EXCLUSIVE):
+        self.client = client
+        self.wheelhouse = wheelhouse
+        self.image_cache = image_cache
+        self.path = path
+        self.pause = pause
+        self.interval = interval
+        self.max_age = max_age
+        self.image_max_age = image_max_age
+        self.exclusive = exclusive
+        self.stopping = threading.Event()
+        self.thread = None
+        self.orphans = []
+        os.makedirs(path, exist_ok=True)
+
+    def put(self, container, staging, images=()):
+        # container: name of the container or sandbox, staging: its wheelhouse staging dir, images: to release to the image cache
+        name = '{}-{}.json'.format(time.time_ns(), staging)
+        tmp_path = os.path.join(self.path, '.' + name)
+        with open(tmp_path, 'w') as f:
+            json.dump({'container': container, 'staging': staging, 'images': list(images)}, f)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+    def pending(self):
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.json') and not name.startswith('.'))
+
+    def remove(self, name):
+        try:
+            container = self.client.containers.get(name)
+        except Exception as e:
+            if settings.Runner.USE_DOCKER and isinstance(e, docker.errors.NotFound):
+                return
+            raise
+        if settings.Runner.USE_DOCKER:
+            container.remove(force=True)
+        else:
+            container.remove(idle_io=True)
+        logger.info('Reaper: removed {}'.format(name))
+
+    def reap(self, request):
+        if request['container']:
+            self.remove(request['container'])
+        self.wheelhouse.discard(request['staging'])
+        # Requests written before 'images' name a single image
+        images = request.get('images') or ([request['image']] if request.get('image') else [])
+        for image in images if self.image_cache else []:
+            self.image_cache.release(image, holder=request['staging'])
+
+    def drain(self):
+        for name in self.pending():
+            if self.stopping.is_set():
+                return
+            filepath = os.path.join(self.path, name)
+            try:
+                with open(filepath) as f:
+                    self.reap(json.load(f))
+            except FileNotFoundError:
+                continue # taken by another reaper
+            except Exception as e:
+                # Dropped, the next sweep catches whatever is left
+                logger.error('Reaper: {} failed: {}'.format(name, e))
+            try:
+                os.remove(filepath)
+            except FileNotFoundError:
+                pass
+            self.stopping.wait(self.pause)
+        metrics.registry.set('aivle_runner_reaper_pending', len(self.pending()))
+
+    def is_orphan(self, container, now):
+        pool = getattr(self.client.containers, 'pool', None)
+        if container.name.startswith(POOL_PREFIX):
+            # Ready sandboxes have a marker, unmarked ones are being provisioned or belong to a job
+            if pool and (container.name in pool.markers() or '.' + container.name in pool.markers()):
+                return False
+        elif container.name.startswith(BATCH_PREFIX):
+            # Owned by the batch process, however long the batch takes
+            pid = container.name[len(BATCH_PREFIX):].split('-')[0]
+            return not (pid.isdigit() and is_alive(int(pid)))
+        elif not container.name.startswith(JOB_PREFIX):
+            return False
+        elif self.exclusive:
+            return True # this watcher is the only runner on the host and has not started any job yet
+        return now - created(container) > self.max_age
+
+    def find_orphans(self):
+        now = time.time()
+        return [container for container in self.client.containers.list(all=True, filters={'name': 'aiVLE-'})
+            if self.is_orphan(container, now)]
+
+    def sweep(self):
+        now = time.time()
+        removed = 0
+        for container in self.orphans:
+            if self.stopping.is_set():
+                return
+            try:
+                logger.info('Reaper: removing orphan {}'.format(container.name))
+                self.remove(container.name)
+                self.wheelhouse.discard(container.name)
+                removed += 1
+            except Exception as e:
+                logger.error('Reaper: cannot remove orphan {}: {}'.format(container.name, e))
+            self.stopping.wait(self.pause)
+        if settings.Runner.USE_DOCKER and self.image_cache:
+            # Baked images and dependency layers are rebuilt on demand, unused ones are of suites no longer graded
+            for image in self.client.images.list(name=settings.Runner.BAKED_IMAGE_REPOSITORY):
+                if not image.tags:
+                    continue
+                if not self.image_cache.last_used(image.tags[0]):
+                    self.image_cache.use(image.tags[0]) # not seen used yet, e.g. baked by an older runner: its age counts from now
+                    continue
+                # A baked image is in use while dependency layers built on it are
+                family = [image] + self.image_cache.children(image)
+                last_used = max(self.image_cache.last_used(tag) or 0 for member in family for tag in member.tags)
+                if now - last_used < self.image_max_age:
+                    continue
+                if self.image_cache.remove(image.tags[0]):
+                    logger.info('Reaper: removed unused image {}'.format(image.tags))
+                    removed += 1
+                else:
+                    logger.info('Reaper: cannot remove unused image {}'.format(image.tags)) # e.g. held by a job
+                self.stopping.wait(self.pause)
+        logger.info('Reaper: sweep removed {} orphan(s)'.format(removed))
+
+    def loop(self):
+        try:
+            self.sweep()
+        except Exception as e:
+            logger.error('Reaper: sweep failed: {}'.format(e))
+        while not self.stopping.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error('Reaper: {}'.format(e))
+            self.stopping.wait(self.interval)
+
+    def start(self):
+        if self.thread is None:
+            # Listed before any job starts, removed in the background
+            try:
+                self.orphans = self.find_orphans()
+            except Exception as e:
+                logger.error('Reaper: cannot list containers: {}'.format(e))
+            self.thread = threading.Thread(target=self.loop, name='reaper', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        # Requests not reaped yet stay on disk for the next start
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
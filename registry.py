@@ -0,0 +1,120 @@
+import re
+import logging
+
+import requests
+
+import settings
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+DOCKER_HUB = 'registry-1.docker.io'
+MANIFEST_TYPES = [
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+
+
+def parse_reference(image):
+    # [registry/]repository[:tag|@digest]
+    name, reference = image, 'latest'
+    if '@' in name:
+        name, reference = name.split('@', 1)
+    elif ':' in name.rsplit('/', 1)[-1]:
+        name, reference = name.rsplit(':', 1)
+    parts = name.split('/', 1)
+    if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+        registry, repository = parts
+    else:
+        registry, repository = DOCKER_HUB, name
+    if registry == DOCKER_HUB and '/' not in repository:
+        repository = 'library/' + repository
+    return registry, repository, reference
+
+def pin(image, digest):
+    # The image reference by digest, what it points to cannot move
+    name = image.split('@', 1)[0]
+    if ':' in name.rsplit('/', 1)[-1]:
+        name = name.rsplit(':', 1)[0]
+    return '{}@{}'.format(name, digest)
+
+
+class Registry(object):
+    """
+    Minimal Docker Registry HTTP API v2 client, only what is needed to size and identify an image before pulling it.
+    """
+    def __init__(self, session=None, insecure=settings.Registry.INSECURE, timeout=settings.Registry.TIMEOUT):
+        self.session = session or requests.Session()
+        self.insecure = insecure
+        self.timeout = timeout
+
+    def url(self, registry, path):
+        scheme = 'http' if registry in self.insecure else 'https'
+        return '{}://{}/v2/{}'.format(scheme, registry, path)
+
+    def token(self, challenge, repository):
+        if not challenge or not challenge.startswith('Bearer '):
+            return None
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        if not realm:
+            return None
+        params.setdefault('scope', 'repository:{}:pull'.format(repository))
+        response = self.session.get(realm, params=params, timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        data = response.json()
+        return data.get('token') or data.get('access_token')
+
+    def manifest(self, registry, repository, reference):
+        response = self.get_manifest(registry, repository, reference)
+        return response.json() if response is not None else None
+
+    def get_manifest(self, registry, repository, reference, method='get'):
+        url = self.url(registry, '{}/manifests/{}'.format(repository, reference))
+        headers = {'Accept': ', '.join(MANIFEST_TYPES)}
+        response = self.session.request(method, url, headers=headers, timeout=self.timeout)
+        if response.status_code == 401:
+            token = self.token(response.headers.get('WWW-Authenticate'), repository)
+            if token is None:
+                return None
+            headers['Authorization'] = 'Bearer {}'.format(token)
+            response = self.session.request(method, url, headers=headers, timeout=self.timeout)
+        if response.status_code != 200:
+            return None
+        return response
+
+    def digest(self, image):
+        # Digest the tag currently points to, None if unknown. HEAD requests do not count against Docker Hub pull limits.
+        try:
+            registry, repository, reference = parse_reference(image)
+            if reference.startswith('sha256:'):
+                return reference
+            response = self.get_manifest(registry, repository, reference, method='head')
+            return response.headers.get('Docker-Content-Digest') if response is not None else None
+        except requests.RequestException as e:
+            logger.info('Digest lookup failed for {}: {}'.format(image, e))
+            return None
+
+    def image_size(self, image, os='linux', architecture='amd64'):
+        # Compressed size in bytes, a lower bound of the size once pulled. None if unknown.
+        try:
+            registry, repository, reference = parse_reference(image)
+            manifest = self.manifest(registry, repository, reference)
+            if manifest and 'manifests' in manifest:
+                # Multi-platform image, size the one that would be pulled
+                platforms = [m for m in manifest['manifests']
+                    if m.get('platform', {}).get('os') == os and m.get('platform', {}).get('architecture') == architecture]
+                if not platforms:
+                    return None
+                manifest = self.manifest(registry, repository, platforms[0]['digest'])
+            if not manifest or 'layers' not in manifest:
+                return None
+            return manifest['config'].get('size', 0) + sum(layer['size'] for layer in manifest['layers'])
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.info('Manifest lookup failed for {}: {}'.format(image, e))
+            return None
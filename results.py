@@ -0,0 +1,159 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+import settings
+import utils
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+COLUMNS = ['id', 'time', 'task', 'agent', 'runner', 'point', 'error_type', 'error', 'data', 'phases', 'suite_hash', 'agent_hash', 'cached']
+JSON_COLUMNS = ['error', 'data', 'phases']
+
+
+class ResultStore(object):
+    """
+    Append-only store of every result: the runner output or the error, per-phase timings and the
+    hashes of what ran. One SQLite file in WAL mode, written by any number of worker processes.
+    """
+    def __init__(self, path=settings.RESULT_STORE_PATH):
+        self.path = path
+        with utils.connect(self.path) as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS results (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, task TEXT, agent TEXT, runner TEXT, point REAL,
+                error_type TEXT, error TEXT, data TEXT, phases TEXT, suite_hash TEXT, agent_hash TEXT, cached INTEGER DEFAULT 0)''')
+            db.execute('CREATE INDEX IF NOT EXISTS results_task ON results (task, time)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_agent ON results (agent, time)')
+            db.execute('CREATE INDEX IF NOT EXISTS results_error ON results (error_type)')
+
+    def record(self, task, agent, data=None, error=None, phases=None, runner=None, suite_hash=None, agent_hash=None,
+        cached=False, created=None):
+        error_type, error_args = None, None
+        if error is not None:
+            error_type, error_args = type(error).__name__, [str(arg) for arg in error.args]
+        point = data.get('point') if isinstance(data, dict) else None
+        with utils.connect(self.path) as db:
+            db.execute('INSERT INTO results ({}) VALUES ({})'.format(', '.join(COLUMNS[1:]), ', '.join('?' * (len(COLUMNS) - 1))),
+                (created or time.time(), str(task) if task is not None else None, str(agent) if agent is not None else None, runner, point, error_type,
+                json.dumps(error_args) if error_args is not None else None, json.dumps(data) if data is not None else None,
+                json.dumps(phases or {}), suite_hash, agent_hash, int(cached)))
+
+    def row(self, row):
+        result = dict(zip(COLUMNS, row))
+        for column in JSON_COLUMNS:
+            if result[column] is not None:
+                result[column] = json.loads(result[column])
+        return result
+
+    def query(self, task=None, agent=None, errors=None, since=None, until=None, latest=False, limit=None):
+        # Newest first. errors: True for failed runs only, False for successful ones only.
+        # latest: only the newest result of each (task, agent).
+        where, args = [], []
+        for column, value in [('task', task), ('agent', agent)]:
+            if value is not None:
+                where.append('{}=?'.format(column))
+                args.append(str(value))
+        if errors is not None:
+            where.append('error_type IS {}NULL'.format('NOT ' if errors else ''))
+        if since is not None:
+            where.append('time>=?')
+            args.append(since)
+        if until is not None:
+            where.append('time<?')
+            args.append(until)
+        if latest:
+            where.append('id IN (SELECT MAX(id) FROM results GROUP BY task, agent)')
+        sql = 'SELECT {} FROM results{} ORDER BY time DESC, id DESC'.format(', '.join(COLUMNS), ' WHERE ' + ' AND '.join(where) if where else '')
+        if limit:
+            sql += ' LIMIT {:d}'.format(limit)
+        with utils.connect(self.path) as db:
+            return [self.row(row) for row in db.execute(sql, args)]
+
+    def scores(self, task):
+        # Points of each agent's latest result, when it succeeded
+        return [result['point'] for result in self.query(task=task, errors=False, latest=True) if result['point'] is not None]
+
+    def summary(self, task):
+        results = self.query(task=task, latest=True)
+        points = sorted(self.scores(task))
+        errors = {}
+        for result in results:
+            if result['error_type']:
+                errors[result['error_type']] = errors.get(result['error_type'], 0) + 1
+        summary = {'task': str(task), 'agents': len(results), 'scored': len(points), 'errors': errors}
+        if points:
+            summary.update(mean=sum(points) / len(points), min=points[0], max=points[-1],
+                p50=points[len(points) // 2], p90=points[min(len(points) - 1, int(len(points) * 0.9))])
+        return summary
+
+    def migrate(self, path=settings.OUTPUT_PATH, remove=False):
+        # Imports outputs/<task>/<agent>.json files, once: files already imported (same task, agent and time) are skipped
+        imported = skipped = 0
+        for task in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+            task_path = os.path.join(path, task)
+            if not os.path.isdir(task_path):
+                continue
+            for name in sorted(os.listdir(task_path)):
+                if not name.endswith('.json'):
+                    continue
+                filepath = os.path.join(task_path, name)
+                agent, created = name[:-len('.json')], os.path.getmtime(filepath)
+                with utils.connect(self.path) as db:
+                    exists = db.execute('SELECT 1 FROM results WHERE task=? AND agent=? AND time=?', (task, agent, created)).fetchone()
+                if exists:
+                    skipped += 1
+                else:
+                    try:
+                        with open(filepath) as f:
+                            data = json.load(f)
+                    except ValueError as e:
+                        logger.error('Migration: skipping unreadable {}: {}'.format(filepath, e))
+                        continue
+                    self.record(task, agent, data=data, created=created)
+                    imported += 1
+                if remove:
+                    os.remove(filepath)
+            if remove and not os.listdir(task_path):
+                os.rmdir(task_path)
+        logger.info('Migration: {} imported, {} already there'.format(imported, skipped))
+        return imported, skipped
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Query the result store')
+    commands = parser.add_subparsers(dest='command')
+    query = commands.add_parser('query', help='results as JSON lines, newest first')
+    query.add_argument('--task')
+    query.add_argument('--agent')
+    query.add_argument('--errors', action='store_true', help='failed runs only')
+    query.add_argument('--latest', action='store_true', help='newest result per agent only')
+    query.add_argument('--since', type=float, help='unix time')
+    query.add_argument('--limit', type=int)
+    scores = commands.add_parser('scores', help='score distribution of a task')
+    scores.add_argument('task')
+    migrate = commands.add_parser('migrate', help='import an outputs/ tree')
+    migrate.add_argument('path', nargs='?', default=settings.OUTPUT_PATH)
+    migrate.add_argument('--remove', action='store_true', help='delete the files once imported')
+    args = parser.parse_args(argv)
+    store = ResultStore()
+    if args.command == 'query':
+        for result in store.query(task=args.task, agent=args.agent, errors=True if args.errors else None,
+            since=args.since, latest=args.latest, limit=args.limit):
+            print(json.dumps(result))
+    elif args.command == 'scores':
+        print(json.dumps(store.summary(args.task), indent=2))
+    elif args.command == 'migrate':
+        store.migrate(args.path, remove=args.remove)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
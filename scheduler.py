@@ -0,0 +1,126 @@
+import os
+import time
+import logging
+import threading
+
+import settings
+import metrics
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+def host_cpus():
+    return sorted(os.sched_getaffinity(0))
+
+def host_memory():
+    # MB
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+class Scheduler(object):
+    """
+    Places jobs on free cores and memory of the host, so concurrent jobs never share a core or
+    oversubscribe memory. A task may declare `cpus` and `memory` (MB), otherwise the defaults apply.
+    Needs larger than the host are capped to it, such a job then runs alone.
+    A job that has waited RESERVE_AFTER seconds gets what it needs held back as it frees up,
+    so a steady stream of smaller jobs cannot starve it.
+    """
+    def __init__(self, cpus=None, memory=None, reserved_cpus=settings.Scheduler.RESERVED_CPUS,
+        reserved_memory=settings.Scheduler.RESERVED_MEMORY, reserve_after=settings.Scheduler.RESERVE_AFTER,
+        forget_after=settings.Scheduler.FORGET_AFTER):
+        cpus = cpus if cpus is not None else host_cpus()
+        # Always leave at least one core to jobs
+        self.cpus = cpus[min(reserved_cpus, len(cpus) - 1):]
+        self.memory = max((memory if memory is not None else host_memory()) - reserved_memory, settings.Scheduler.MEMORY)
+        self.lock = threading.Lock()
+        self.free_cpus = set(self.cpus)
+        self.free_memory = self.memory
+        self.reserve_after = reserve_after
+        self.forget_after = forget_after
+        self.waiting = {} # job id -> (waiting since, cpus, memory, last tried)
+        logger.info('Scheduling on cores {} with {} MB'.format(self.cpus, self.memory))
+        self.update_metrics()
+
+    def need(self, task):
+        cpus = int((task or {}).get('cpus') or settings.Scheduler.CPUS)
+        memory = int((task or {}).get('memory') or settings.Scheduler.MEMORY)
+        return min(max(cpus, 1), len(self.cpus)), min(memory, self.memory)
+
+    @property
+    def reserved(self):
+        # The longest waiting job, once it has waited long enough
+        with self.lock:
+            return self._reserved(time.time())
+
+    def _reserved(self, now):
+        for job, (since, _, _, tried) in list(self.waiting.items()):
+            if now - tried > self.forget_after:
+                del self.waiting[job]
+        waiting = sorted((since, job) for job, (since, _, _, _) in self.waiting.items() if now - since >= self.reserve_after)
+        return waiting[0][1] if waiting else None
+
+    def queued(self, jobs):
+        # Job ids of the latest poll, a waiting job that left the queue (e.g. claimed by another runner) holds nothing
+        with self.lock:
+            for job in list(self.waiting):
+                if job not in jobs:
+                    del self.waiting[job]
+        self.update_metrics()
+
+    def allocate(self, task, job=None):
+        # Returns the cores and memory reserved for the job, or None if they are not free
+        cpus, memory = self.need(task)
+        now = time.time()
+        with self.lock:
+            free_cpus, free_memory = len(self.free_cpus), self.free_memory
+            reserved = self._reserved(now)
+            if reserved is not None and reserved != job:
+                _, reserved_cpus, reserved_memory, _ = self.waiting[reserved]
+                free_cpus, free_memory = free_cpus - reserved_cpus, free_memory - reserved_memory
+            if free_cpus < cpus or free_memory < memory:
+                if job is not None:
+                    self.waiting[job] = (self.waiting.get(job, (now,))[0], cpus, memory, now)
+                return None
+            self.waiting.pop(job, None)
+            allocated = sorted(self.free_cpus)[:cpus]
+            self.free_cpus.difference_update(allocated)
+            self.free_memory -= memory
+        self.update_metrics()
+        return {'cpus': allocated, 'memory': memory}
+
+    def release(self, allocation):
+        if not allocation:
+            return
+        with self.lock:
+            self.free_cpus.update(allocation['cpus'])
+            self.free_memory += allocation['memory']
+        self.update_metrics()
+
+    def update_metrics(self):
+        metrics.registry.set('aivle_runner_free_cpus', len(self.free_cpus))
+        metrics.registry.set('aivle_runner_free_memory_megabytes', self.free_memory)
+        metrics.registry.set('aivle_runner_waiting_jobs', len(self.waiting))
+
+
+class TaskCache(object):
+    # Task resource needs are looked up before a job is claimed, tasks rarely change
+    def __init__(self, api, ttl=settings.Scheduler.TASK_TTL):
+        self.api = api
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.tasks = {} # url -> (task, fetch time)
+
+    def get(self, url):
+        with self.lock:
+            task, fetched = self.tasks.get(url, (None, 0))
+        if task is None or time.time() - fetched > self.ttl:
+            response = self.api.base.request(url)
+            if response.status_code != 200:
+                raise Exception('Task download failed')
+            task = response.json()
+            with self.lock:
+                self.tasks[url] = (task, time.time())
+        return task
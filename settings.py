@@ -2,11 +2,15 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-BASE_PATH = os.path.dirname(os.path.realpath(__file__))
-RUNNER_PATH = os.path.join(BASE_PATH, 'runner-kit')
+SOURCE_PATH = os.path.dirname(os.path.realpath(__file__))
+BASE_PATH = os.getenv("RUNNER_BASE_PATH") or SOURCE_PATH # agents, suites, outputs and caches
+RUNNER_PATH = os.path.join(SOURCE_PATH, 'runner-kit')
 AGENTS_PATH = os.path.join(BASE_PATH, 'agents')
 SUITES_PATH = os.path.join(BASE_PATH, 'suites')
-OUTPUT_PATH = os.path.join(BASE_PATH, 'outputs')
+OUTPUT_PATH = os.path.join(BASE_PATH, 'outputs') # legacy per-result JSON files, see results.py migrate
+RESULT_STORE_PATH = os.path.join(BASE_PATH, 'results.sqlite3')
+LOG_PATH = os.path.join(BASE_PATH, 'logs')
+ARTIFACT_INDEX_PATH = os.path.join(BASE_PATH, 'artifacts.sqlite3')
 
 class Runner:
     PYTHON_DOCKER_IMAGE = 'python:3.7'
@@ -14,20 +18,105 @@ class Runner:
     SETUP_TIME_LIMIT = 10 * 60 # seconds
     RUN_TIME_LIMIT = 1 * 60 * 60 # seconds
     MAX_IMAGE_SIZE = 1000000 # KB
+    LOG_MAX_SIZE = 10000 # KB, per job
+    RESULT_MAX_SIZE = 10000 # KB, runner stdout kept for the JSON result
+    ERROR_TAIL_SIZE = 64 # KB, command output kept for error messages
+    EXEC_EXIT_TIMEOUT = 5 # seconds, for Docker to report the exit code once an exec's output ends
+    BAKED_IMAGE_REPOSITORY = 'aivle-runner-baked'
+    BAKED_IMAGE_LABEL = 'aivle.suite'
+    IMAGE_KIND_LABEL = 'aivle.kind' # 'baked' or 'layer'
     USE_DOCKER = False
+    BATCH_WORKERS = int(os.getenv("RUNNER_BATCH_WORKERS") or 1) # agents evaluated at once by core.Batch
+
+class Scheduler:
+    CPUS = 1 # cores per job, unless the task declares `cpus`
+    MEMORY = 2048 # MB per job, unless the task declares `memory`
+    RESERVED_CPUS = int(os.getenv("SCHEDULER_RESERVED_CPUS") or 1) # left to the watcher and Docker daemon
+    RESERVED_MEMORY = int(os.getenv("SCHEDULER_RESERVED_MEMORY") or 1024) # MB
+    TASK_TTL = 60 # seconds a task's needs are cached
+    RESERVE_AFTER = 60 # seconds a job waits for cores/memory before smaller jobs stop taking them
+    FORGET_AFTER = 10 * 60 # seconds since a waiting job was last tried, jobs that left the queue are dropped on the next poll
+
+class Reaper:
+    PATH = os.path.join(BASE_PATH, 'reaper') # pending teardowns
+    ENABLED = (os.getenv("REAPER") or '1') == '1' # tear down watcher jobs in the background
+    EXCLUSIVE = (os.getenv("REAPER_EXCLUSIVE") or '1') == '1' # only runner on the host, every job container found at start is an orphan
+    MAX_AGE = Runner.PULL_TIME_LIMIT + Runner.SETUP_TIME_LIMIT + Runner.RUN_TIME_LIMIT + 10 * 60 # seconds, older containers are orphans
+    IMAGE_MAX_AGE = 14 * 24 * 60 * 60 # seconds since baked images and dependency layers were last used
+    PAUSE = 1 # seconds between removals
+    INTERVAL = 2 # seconds between queue scans
+
+class Download:
+    RETRIES = 5
+    POOL_SIZE = 10 # connections per host
+    TIMEOUT = 60 # seconds, per read
+
+class Registry:
+    INSECURE = [r for r in (os.getenv("REGISTRY_INSECURE") or '').split(',') if r] # registries served over http, e.g. localhost:5000
+    TIMEOUT = 10 # seconds
+
+class ImageCache:
+    MAX_SIZE = 20000000 # KB
+    PINNED = [Runner.PYTHON_DOCKER_IMAGE]
+    STATE_PATH = os.path.join(BASE_PATH, 'image_cache.json')
+    HOLD_TIME = Runner.PULL_TIME_LIMIT + Runner.SETUP_TIME_LIMIT + Runner.RUN_TIME_LIMIT # seconds, holds of crashed jobs expire
+
+class Wheelhouse:
+    PATH = os.getenv("WHEELHOUSE_PATH") or os.path.join(BASE_PATH, 'wheelhouse')
+    MAX_SIZE = 10000000 # KB
+
+class Layers:
+    PATH = os.getenv("LAYERS_PATH") or os.path.join(BASE_PATH, 'layers') # agent dependency layers of sandboxes
+    MAX_SIZE = 20000000 # KB
 
 class VirtualEnv:
     PYTHON_VERSION = '3.7.2'
     ROOT_PATH = os.getenv("VIRTUALENV_ROOT") or os.path.join(BASE_PATH, 'virtualenvs')
     USE_FIREJAIL = True
     SHARED_PATH = os.getenv("VIRTUALENV_SHARED_PATH")
+    POOL_SIZE = int(os.getenv("VIRTUALENV_POOL_SIZE") or 2) # ready sandboxes, 0 to disable
+    POOL_INTERVAL = 5 # seconds
+    COMMAND_TIMEOUT = 2 * 60 * 60 # seconds, per sandbox command
+    # Memory cap of sandbox commands: 'cgroup' (systemd-run scope, skipped where systemd is not running),
+    # 'rlimit' (address space, breaks agents that reserve large virtual memory such as torch/BLAS) or 'none'
+    MEMORY_LIMIT = os.getenv("VIRTUALENV_MEMORY_LIMIT") or 'cgroup'
 
 class Watcher:
     API = os.getenv("WATCHER_API")
     USERNAME = os.getenv("WATCHER_USERNAME")
     PASSWORD = os.getenv("WATCHER_PASSWORD")
     SLEEP = int(os.getenv("WATCHER_SLEEP"))
-    PROCESSES = 1
+    MIN_SLEEP = 0.5 # seconds, re-poll interval while the queue is busy
+    MAX_SLEEP = int(os.getenv("WATCHER_MAX_SLEEP") or 8 * SLEEP) # seconds, backoff cap
+    JITTER = 0.5 # fraction of the poll interval
+    CLAIM_SPREAD = 2 # claim among the first CLAIM_SPREAD * free slots queued jobs
+    STATS_EVERY = 100 # polls
+    PROCESSES = int(os.getenv("WATCHER_PROCESSES") or 1)
+    PREFETCH_DEPTH = int(os.getenv("WATCHER_PREFETCH_DEPTH") or 2) # queued jobs, 0 to disable
+    PREFETCH_MAX_SIZE = 5000000 # KB
+    PREFETCH_WORKERS = 2
+    USE_ASYNC = (os.getenv("WATCHER_ASYNC") or '1') == '1' # AsyncJobWatcher instead of JobWatcher
+    DOWNLOADS = 4 # concurrent downloads
+    REQUESTS = 4 # concurrent API calls
+
+class Metrics:
+    PORT = int(os.getenv("METRICS_PORT") or 0) # /metrics on 127.0.0.1, 0 to disable
+    FILE = os.getenv("METRICS_FILE") or os.path.join(BASE_PATH, 'metrics.prom')
+    LOG_PATH = os.path.join(BASE_PATH, 'timings.jsonl') # per job phase timings
+    INTERVAL = 15 # seconds between FILE rewrites
+
+class ResultCache:
+    ENABLED = (os.getenv("RESULT_CACHE") or '1') == '1'
+    PATH = os.path.join(BASE_PATH, 'results_cache.sqlite3')
+
+class Outbox:
+    PATH = os.path.join(BASE_PATH, 'outbox')
+    INTERVAL = 1 # seconds between flushes, and base retry delay
+    MAX_DELAY = 10 * 60 # seconds
+    BATCH_ACTION = os.getenv("OUTBOX_BATCH_ACTION") # bulk end endpoint, if the API has one
+    BATCH_SIZE = 50
 
 class Submission:
     API = os.getenv("SUBMISSION_API")
+    WORKERS = 8 # concurrent downloads
+    PROGRESS_EVERY = 50 # submissions
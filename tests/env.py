@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# Settings are read at import time, point them at a scratch dir before any runner module is imported
+BASE_PATH = tempfile.mkdtemp(prefix='aivle-test-')
+os.environ.setdefault('WATCHER_SLEEP', '1')
+os.environ['RUNNER_BASE_PATH'] = BASE_PATH
+os.environ['XDG_RUNTIME_DIR'] = BASE_PATH
+os.environ.setdefault('USER', 'test')
+os.environ['VIRTUALENV_ROOT'] = os.path.join(BASE_PATH, 'virtualenvs')
+os.environ['VIRTUALENV_POOL_SIZE'] = '0'
+os.environ['METRICS_PORT'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+import os
+import time
+import shutil
+import threading
+import unittest
+from unittest import mock
+
+import env
+import settings
+import utils
+import deadline
+import core
+import virtualenv
+
+
+class AbortTest(unittest.TestCase):
+    # Sandbox without firejail, commands are whatever is linked into its venv
+    def setUp(self):
+        patcher = mock.patch.object(settings.VirtualEnv, 'USE_FIREJAIL', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.runnable = core.Runnable(1, 1, name='aiVLE-runner-abort')
+        self.runnable.container = virtualenv.Container(settings.VirtualEnv.PYTHON_VERSION, name=self.runnable.container_name)
+        os.makedirs(os.path.join(self.runnable.container.venv_path, 'bin'))
+        os.symlink(shutil.which('sleep'), os.path.join(self.runnable.container.venv_path, 'bin', 'sleep'))
+
+    def tearDown(self):
+        self.runnable.destroy()
+
+    def test_nothing_runs_after_the_deadline(self):
+        start = time.monotonic()
+        with self.assertRaises(utils.TimeoutException):
+            with deadline.limit(1, 'Setup time limit exceeded', on_expire=self.runnable.abort):
+                self.runnable.exec_run('sleep 2')
+                self.runnable.exec_run('sleep 2')
+        self.assertLess(time.monotonic() - start, 1.9)
+
+    def test_killed_command_fails(self):
+        # Killed by a signal, the exit code is negative
+        timer = threading.Timer(0.5, self.runnable.container.kill)
+        timer.start()
+        with self.assertRaises(core.RunnerError):
+            self.runnable.exec_run('sleep 2', exception=core.RunnerError)
+        timer.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
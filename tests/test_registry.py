@@ -0,0 +1,118 @@
+import json
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import env
+import core
+from registry import Registry, parse_reference, pin
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+    # Registry API v2 stand-in: manifests by repository and reference, behind a bearer token like Docker Hub
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        registry = self.server.registry
+        if self.path.startswith('/token'):
+            return self.reply(200, json.dumps({'token': 'secret'}).encode('utf8'))
+        registry.requests.append((self.command, self.path))
+        if self.headers.get('Authorization') != 'Bearer secret':
+            return self.reply(401, headers={'WWW-Authenticate': 'Bearer realm="{}token",service="stand-in"'.format(registry.url)})
+        manifest = registry.manifests.get(self.path)
+        if manifest is None:
+            return self.reply(404)
+        return self.reply(200, json.dumps(manifest).encode('utf8'), headers={
+            'Content-Type': manifest['mediaType'], 'Docker-Content-Digest': registry.digests.get(self.path, 'sha256:0')})
+
+    do_HEAD = do_GET
+
+
+class RegistryStandIn(object):
+    def __init__(self):
+        self.manifests = {}
+        self.digests = {}
+        self.requests = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RegistryHandler)
+        self.server.daemon_threads = True
+        self.server.registry = self
+        self.host = '127.0.0.1:{}'.format(self.server.server_address[1])
+        self.url = 'http://{}/'.format(self.host)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def push(self, repository, tag, layer_sizes, digest='sha256:0'):
+        path = '/v2/{}/manifests/{}'.format(repository, tag)
+        self.manifests[path] = {
+            'mediaType': 'application/vnd.docker.distribution.manifest.v2+json',
+            'config': {'size': 1000},
+            'layers': [{'size': size} for size in layer_sizes],
+        }
+        self.digests[path] = digest
+        return '{}/{}:{}'.format(self.host, repository, tag)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeImageCache(object):
+    def local(self, name):
+        return None
+
+
+class ImageSizeTest(unittest.TestCase):
+    def setUp(self):
+        self.stand_in = RegistryStandIn()
+        self.registry = Registry(insecure=[self.stand_in.host])
+        self.original = core.registry, core.image_cache
+        core.registry, core.image_cache = self.registry, FakeImageCache()
+
+    def tearDown(self):
+        core.registry, core.image_cache = self.original
+        self.stand_in.close()
+
+    def runnable(self, image, max_image_size):
+        return core.Runnable(1, 1, runner_type=core.RunnerType.Docker, image=image, max_image_size=max_image_size)
+
+    def test_parse_reference(self):
+        self.assertEqual(parse_reference('python:3.7'), ('registry-1.docker.io', 'library/python', '3.7'))
+        self.assertEqual(parse_reference('localhost:5000/agent'), ('localhost:5000', 'agent', 'latest'))
+
+    def test_digest_without_pulling_the_manifest(self):
+        image = self.stand_in.push('student/agent', 'v1', [2000], digest='sha256:abc')
+        self.assertEqual(self.registry.digest(image), 'sha256:abc')
+        self.assertTrue(all(method == 'HEAD' for method, _ in self.stand_in.requests))
+        self.assertEqual(pin(image, 'sha256:abc'), '{}/student/agent@sha256:abc'.format(self.stand_in.host))
+
+    def test_size_from_manifest(self):
+        image = self.stand_in.push('student/agent', 'v1', [2000, 3000])
+        self.assertEqual(self.registry.image_size(image), 6000)
+
+    def test_over_limit(self):
+        image = self.stand_in.push('student/agent', 'big', [3000000])
+        with self.assertRaises(core.MaxImageSizeExceeded):
+            self.runnable(image, max_image_size=1000).check_image_size()
+
+    def test_under_limit(self):
+        image = self.stand_in.push('student/agent', 'small', [3000])
+        self.runnable(image, max_image_size=1000).check_image_size()
+
+    def test_missing_manifest(self):
+        # Unknown size, left to the check after the pull
+        image = '{}/student/agent:missing'.format(self.stand_in.host)
+        self.assertIsNone(self.registry.image_size(image))
+        self.runnable(image, max_image_size=1000).check_image_size()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import env
+import settings
+import virtualenv
+from wheelhouse import Wheelhouse
+
+
+@unittest.skipUnless(settings.VirtualEnv.USE_FIREJAIL and shutil.which('firejail'), 'firejail is not installed')
+class FirejailStagingTest(unittest.TestCase):
+    def setUp(self):
+        os.makedirs(virtualenv.SHARED_PATH, exist_ok=True)
+        self.wheelhouse = Wheelhouse(virtualenv.WHEELHOUSE_PATH, staging_path=virtualenv.STAGING_PATH)
+        self.container = virtualenv.Container(settings.VirtualEnv.PYTHON_VERSION, name='aiVLE-runner-test')
+        os.makedirs(self.container.path)
+        self.container.mount({
+            self.wheelhouse.path: {'bind': '/aiVLE-runner-test/wheelhouse', 'mode': 'ro'},
+            self.wheelhouse.staging('aiVLE-runner-test'): {'bind': '/aiVLE-runner-test/wheels', 'mode': 'rw'},
+        })
+
+    def tearDown(self):
+        self.container.remove()
+        self.wheelhouse.discard('aiVLE-runner-test')
+
+    def test_staging_is_writable(self):
+        # Wheel and layer builds write here
+        wheels = self.container.get_path('/aiVLE-runner-test/wheels')
+        exit_code, output = self.container._exec_run('mkdir {0}/key && touch {0}/key/built.whl'.format(wheels))
+        self.assertEqual(exit_code, 0, output)
+        self.assertTrue(os.path.isfile(os.path.join(self.container.volume_path('/aiVLE-runner-test/wheels'), 'key', 'built.whl')))
+
+    def test_wheelhouse_is_read_only(self):
+        exit_code, _ = self.container._exec_run('touch {}/deps/injected.whl'.format(self.wheelhouse.path))
+        self.assertNotEqual(exit_code, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.wheelhouse.deps_path, 'injected.whl')))
+
+
+class ExecRunPathsTest(unittest.TestCase):
+    # Without firejail, so it runs wherever the tests do: volumes are symlinks into the sandbox dir
+    def setUp(self):
+        patcher = mock.patch.object(settings.VirtualEnv, 'USE_FIREJAIL', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.wheelhouse = Wheelhouse(os.path.join(env.BASE_PATH, 'wheelhouse'), staging_path=os.path.join(env.BASE_PATH, 'staging'))
+        self.container = virtualenv.Container(settings.VirtualEnv.PYTHON_VERSION, name='aiVLE-runner-paths')
+        os.makedirs(os.path.join(self.container.venv_path, 'bin'))
+        os.symlink(shutil.which('ls'), os.path.join(self.container.venv_path, 'bin', 'ls'))
+        self.container.mount({
+            self.wheelhouse.path: {'bind': '/aiVLE-runner-paths/wheelhouse', 'mode': 'ro'},
+            self.wheelhouse.staging('aiVLE-runner-paths'): {'bind': '/aiVLE-runner-paths/wheels', 'mode': 'rw'},
+        })
+
+    def tearDown(self):
+        self.container.remove()
+        self.wheelhouse.discard('aiVLE-runner-paths')
+
+    def test_every_path_of_a_command(self):
+        open(os.path.join(self.wheelhouse.deps_path, 'dep-1.0-py3-none-any.whl'), 'w').close()
+        os.makedirs(os.path.join(self.wheelhouse.staging('aiVLE-runner-paths'), 'suite-key_1'))
+        open(os.path.join(self.wheelhouse.staging('aiVLE-runner-paths'), 'suite-key_1', 'built.whl'), 'w').close()
+        exit_code, output = self.container.exec_run('ls /aiVLE-runner-paths/wheelhouse/deps /aiVLE-runner-paths/wheels/suite-key_1')
+        self.assertEqual(exit_code, 0, output)
+        self.assertIn(b'dep-1.0-py3-none-any.whl', output)
+        self.assertIn(b'built.whl', output)
+
+    def test_paths_are_replaced_once(self):
+        command = self.container.replace_abspath('pip wheel --find-links /X/wheels -w /X/wheels/k-1 /X/suite.zip')
+        self.assertEqual(command, 'pip wheel --find-links {} -w {} {}'.format(self.container.get_path('/X/wheels'),
+            self.container.get_path('/X/wheels/k-1'), self.container.get_path('/X/suite.zip')))
+
+
+if __name__ == '__main__':
+    unittest.main()
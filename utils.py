@@ -1,8 +1,10 @@
+import os
+import random
+import sqlite3
 import secrets
 import string
 import hashlib
 
-import signal
 import time
 from contextlib import contextmanager
 
@@ -19,22 +21,91 @@ def hash_file(file, block_size=65536):
         hasher.update(data)
     return hasher.hexdigest()
 
+def hash_dir(path, block_size=65536):
+    hasher = hashlib.md5()
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in sorted(files):
+            filepath = os.path.join(root, name)
+            hasher.update(os.path.relpath(filepath, path).encode('utf8'))
+            with open(filepath, 'rb') as f:
+                hasher.update(hash_file(f, block_size).encode('utf8'))
+    return hasher.hexdigest()
 
-# Reference: https://stackoverflow.com/a/601168
 
-class TimeoutException(Exception): pass
+class Tail(object):
+    # Keeps only the last max_size bytes written
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.max_size:
+            del self.buffer[:len(self.buffer) - self.max_size]
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+class CappedLog(object):
+    # Log file that stops growing at max_size bytes
+    def __init__(self, path, max_size):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'wb')
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+
+    def write(self, data):
+        if self.truncated:
+            return
+        room = self.max_size - self.size
+        if len(data) > room:
+            data = data[:room] + b'\n[log truncated]\n'
+            self.truncated = True
+        self.file.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class Backoff(object):
+    # Poll interval: exponential growth while idle or failing, back to minimum when busy, always jittered
+    def __init__(self, base, minimum, maximum, factor=2, jitter=0.5):
+        self.base = base
+        self.minimum = minimum
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.interval = base
+
+    def busy(self):
+        self.interval = self.minimum
+
+    def idle(self):
+        self.interval = min(self.maximum, max(self.base, self.interval * self.factor))
+
+    def next(self):
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
 
 @contextmanager
-def time_limit(seconds, message="Time limit exceeded"):
-    if seconds:
-        def signal_handler(signum, frame):
-            raise TimeoutException(message)
-        signal.signal(signal.SIGALRM, signal_handler)
-        signal.alarm(seconds)
+def connect(path):
+    # SQLite stores: one connection per operation, safe across threads and forked workers
+    db = sqlite3.connect(path, timeout=30)
     try:
-        yield
+        with db:
+            yield db
     finally:
-        signal.alarm(0)
+        db.close()
+
+
+class TimeoutException(Exception): pass
+
 
 @contextmanager
 def time_print(task_name):
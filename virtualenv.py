@@ -1,32 +1,183 @@
 import utils
 import settings
 import os
-import subprocess
 import re
+import glob
+import shlex
+import queue
+import signal
+import asyncio
 import shutil
+import fcntl
+import threading
+import multiprocessing
 from distutils.dir_util import copy_tree
 from distutils.file_util import copy_file
 
 
 if settings.VirtualEnv.USE_FIREJAIL:
     ROOT_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR'), os.environ.get('USER'))
-    SHARED_PATH = os.path.join(ROOT_PATH, 'shared')
 else:
     ROOT_PATH = settings.VirtualEnv.ROOT_PATH
+SHARED_PATH = os.path.join(ROOT_PATH, 'shared')
+PYENV_ROOT = os.path.join(SHARED_PATH, 'pyenv') # interpreters, read-only for sandboxes
+WHEELHOUSE_PATH = os.path.join(SHARED_PATH, 'wheelhouse')
+STAGING_PATH = os.path.join(ROOT_PATH, 'staging') # wheel builds, must be writable so not in the shared area
+LAYERS_PATH = os.path.join(SHARED_PATH, 'layers') # agent dependencies, see layers.py
+POOL_PATH = os.path.join(ROOT_PATH, 'pool')
+RUNNER_BIND = '/runner-kit'
+
+
+def kill_tree(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
 
 
-def exec(command):
+class Engine(object):
+    """
+    Runs sandbox commands on an asyncio event loop in a background thread. Any number of
+    sandboxes can run commands at once; callers consume stdout and stderr as they stream in.
+    At most `max_chunks` chunks are buffered per command, a command that outputs faster than
+    its caller consumes blocks on its pipes.
+    """
+    def __init__(self, block_size=65536, max_chunks=64):
+        self.block_size = block_size
+        self.max_chunks = max_chunks
+        self.lock = threading.Lock()
+        self.loop = None
+        self.pid = None
+
+    def get_loop(self):
+        with self.lock:
+            # The loop thread does not survive fork
+            if self.loop is None or self.pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name='virtualenv-engine', daemon=True).start()
+                self.pid = os.getpid()
+            return self.loop
+
+    async def pump(self, stream, chunks, index):
+        while True:
+            data = await stream.read(self.block_size)
+            if not data:
+                break
+            await self.put(chunks, (data, None) if index == 0 else (None, data))
+
+    async def put(self, chunks, chunk):
+        # Never blocks the loop, other sandboxes share it
+        while True:
+            try:
+                return chunks.put_nowait(chunk)
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def execute(self, command, cwd, timeout, chunks, processes):
+        # New session so the whole (firejail) process tree can be killed at once
+        p = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=cwd, start_new_session=True)
+        if processes is not None:
+            processes.add(p)
+        try:
+            await asyncio.wait_for(asyncio.gather(self.pump(p.stdout, chunks, 0), self.pump(p.stderr, chunks, 1), p.wait()), timeout)
+        except asyncio.TimeoutError:
+            await self.put(chunks, (None, 'Command timed out after {} seconds\n'.format(timeout).encode('utf8')))
+            kill_tree(p.pid)
+            await p.wait()
+        finally:
+            if processes is not None:
+                processes.discard(p)
+        return p.returncode
+
+    def stream(self, command, cwd=None, timeout=None, processes=None):
+        # Yields (stdout, stderr) chunks and returns the exit code
+        chunks = queue.Queue(maxsize=self.max_chunks)
+        future = asyncio.run_coroutine_threadsafe(self.execute(command, cwd, timeout, chunks, processes), self.get_loop())
+        while True:
+            try:
+                yield chunks.get(timeout=0.1)
+            except queue.Empty:
+                # Every chunk is queued before the command completes
+                if future.done() and chunks.empty():
+                    break
+        return future.result()
+
+engine = Engine()
+
+
+def run(command, cwd=None, timeout=None, processes=None):
+    out, err = bytearray(), bytearray()
+    stream = engine.stream(command, cwd=cwd, timeout=timeout, processes=processes)
+    while True:
+        try:
+            stdout, stderr = next(stream)
+        except StopIteration as e:
+            return e.value, bytes(out), bytes(err)
+        out += stdout or b''
+        err += stderr or b''
+
+def exec(command, cwd=None, timeout=settings.VirtualEnv.COMMAND_TIMEOUT, processes=None):
     print('Executing:', command)
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-    out, err = p.communicate()
-    exit_code = p.returncode
+    exit_code, out, err = run(command, cwd=cwd, timeout=timeout, processes=processes)
 
-    output = out
-    if err:
-        output = err
+    # Keep both, pip warnings on stderr must not hide stdout
+    output = out + err
 
     print(exit_code, output)
     return exit_code, output
+
+
+_cgroup_scopes = None
+
+def cgroup_scopes():
+    # Whether transient systemd scopes can be created here, checked once per process
+    global _cgroup_scopes
+    if _cgroup_scopes is None:
+        _cgroup_scopes = bool(shutil.which('systemd-run')) and run('systemd-run {}--scope --quiet true'.format(
+            '' if os.geteuid() == 0 else '--user '))[0] == 0
+        if not _cgroup_scopes:
+            print('No systemd scopes, sandbox memory is not limited')
+    return _cgroup_scopes
+
+def memory_limit(command, mem_limit):
+    if settings.VirtualEnv.MEMORY_LIMIT == 'cgroup' and cgroup_scopes():
+        # Resident memory, without swap on top, like Docker's mem_limit
+        return 'systemd-run {}--scope --quiet -p MemoryMax={} -p MemorySwapMax=0 {}'.format(
+            '' if os.geteuid() == 0 else '--user ', mem_limit, command)
+    if settings.VirtualEnv.MEMORY_LIMIT == 'rlimit':
+        return 'prlimit --as={} {}'.format(mem_limit, command)
+    return command
+
+
+def copy_tree_cow(src, dst):
+    # Copy-on-write where the filesystem supports it (btrfs, XFS), a plain copy elsewhere.
+    # Never hard links: a sandbox can write to its files, which would change them in every other copy.
+    exit_code, _, output = run('cp -a --reflink=auto {} {}'.format(shlex.quote(src), shlex.quote(dst)))
+    if exit_code != 0:
+        print('Copy-on-write copy failed, copying:', output)
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst, symlinks=True)
+
+
+def python_path(version):
+    return os.path.join(PYENV_ROOT, 'versions', version, 'bin', 'python')
+
+def build_python(version=settings.VirtualEnv.PYTHON_VERSION):
+    # Each version is compiled once into the shared area and reused by every sandbox
+    path = python_path(version)
+    if os.path.isfile(path):
+        return path
+    os.makedirs(SHARED_PATH, exist_ok=True)
+    with open(os.path.join(ROOT_PATH, '.pyenv.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isfile(path):
+            if not os.path.isdir(os.path.join(PYENV_ROOT, 'bin')):
+                exec('curl https://pyenv.run | PYENV_ROOT={} bash'.format(PYENV_ROOT))
+            exit_code, output = exec('PYENV_ROOT={0} {0}/bin/pyenv install -s {1}'.format(PYENV_ROOT, version))
+            if exit_code != 0 or not os.path.isfile(path):
+                raise Exception('Python {} build failed'.format(version), output)
+    return path
     
   
 
@@ -60,48 +211,53 @@ class Images(object):
         pass
 
 
-class Container(object): # WARNING: no support for multiple instance existing at the same time
+class Container(object):
     def __init__(self, image, **kwargs):
         self.image = image
         self.volumes = kwargs.get('volumes', {})
         self.name = kwargs.get('name', utils.generate_secure_string(16))
         self.path = os.path.join(ROOT_PATH, self.name)
+        self.venv_path = os.path.join(self.path, 'venv')
         self.network = True
+        self.processes = set()
+        self.provisioned = kwargs.get('provisioned', False)
+        self.runner_installed = kwargs.get('runner_installed', False)
+        self.cpuset_cpus = kwargs.get('cpuset_cpus', None)
+        self.mem_limit = kwargs.get('mem_limit', None) # bytes
 
     def get_path(self, path):
         return os.path.join(self.path, *path.split('/'))
           
     def replace_abspath(self, command):
-        matches = re.finditer(r" (\/[a-zA-Z.-_]*)", command, re.MULTILINE)
-
-        for match in matches:
-            path = match.groups()[0]
-            relative_path = self.get_path(path)
-            command = command.replace(path, relative_path)
-
-        return command
+        # Absolute paths are in the container, one pass so a replaced path is never replaced again
+        return re.sub(r" (/[\w./-]*)", lambda match: ' ' + self.get_path(match.group(1)), command)
 
-    def start(self):
-        # Create working folder and cd
+    def provision(self):
+        # Create working folder
         os.makedirs(self.path, exist_ok=True)
-        os.chdir(self.path)
-        # Provide pyenv for firejail
-        if settings.VirtualEnv.USE_FIREJAIL:
-            self._exec_run('curl https://pyenv.run | bash')
-            self._exec_run('pyenv install {}'.format(self.image))
-        # Create virtual environment
-        self._exec_run('pyenv virtualenv {} {}'.format(self.image, self.name))
+        # Create virtual environment from the shared interpreter
+        exit_code, output = self._exec_run('{} -m venv {}'.format(build_python(self.image), self.venv_path))
+        if exit_code != 0:
+            raise Exception('Virtual environment creation failed', output)
         # Update pip
         self.exec_run('pip install --upgrade pip')
+        # Install runner-kit ahead, jobs then only need the agent and suite
+        self.mount({settings.RUNNER_PATH: {'bind': RUNNER_BIND, 'mode': 'ro'}})
+        exit_code, _ = self.exec_run('pip install {}'.format(RUNNER_BIND))
+        self.runner_installed = exit_code == 0
+        self.provisioned = True
+
+    def mount(self, volumes):
         # Symlink volumes to working folder
-        for src, dst in self.volumes.items():
+        for src, dst in volumes.items():
             relative_dst = self.get_path(dst['bind'])
             os.makedirs(os.path.dirname(relative_dst), exist_ok=True)
             try:
                 os.remove(relative_dst)
             except:
                 pass
-            if settings.VirtualEnv.USE_FIREJAIL:
+            # The shared area is visible (read-only) inside firejail, no need to copy
+            if settings.VirtualEnv.USE_FIREJAIL and not src.startswith(SHARED_PATH):
                 if os.path.isfile(src):
                     copy_file(src, relative_dst)
                 else:
@@ -109,39 +265,195 @@ class Container(object): # WARNING: no support for multiple instance existing at
             else:
                 os.symlink(src, relative_dst)
 
-    def _exec_run(self, command, **kwargs):
-        # Set pyenv dir, otherwise it will detect the original pyenv which is inaccessible
-        command = 'PYENV_DIR={} {}'.format(self.path, command)
+    def volume_path(self, path):
+        # Where the host sees files written to a volume
+        return os.path.realpath(self.get_path(path))
+
+    def start(self):
+        if not self.provisioned:
+            self.provision()
+        self.mount(self.volumes)
+
+    def wrap(self, command):
         # Wrap with firejail
         if settings.VirtualEnv.USE_FIREJAIL:
             network = '' if self.network else ' --net=none'
-            command = 'firejail{} --private-dev --private={} --read-only={} --quiet bash -c "{}"'.format(network, self.path, SHARED_PATH, command)
-        return exec(command)
+            limits = ''
+            if self.cpuset_cpus:
+                limits += ' --cpu={}'.format(self.cpuset_cpus)
+            command = 'firejail{}{} --private-dev --private={} --read-only={} --quiet bash -c "{}"'.format(network, limits, self.path, SHARED_PATH, command)
+        elif self.cpuset_cpus:
+            # Same pinning with util-linux
+            command = 'taskset -c {} {}'.format(self.cpuset_cpus, command)
+        if self.mem_limit:
+            command = memory_limit(command, self.mem_limit)
+        return command
 
-    def exec_run(self, command, **kwargs):
+    def venv_command(self, command):
         # detect and replace absolute path with get_path
         command = self.replace_abspath(command)
-        # Run command
-        command = 'PYENV_VERSION={} pyenv exec {}'.format(self.name, command)
+        # Run command inside the virtualenv
+        return '{}/bin/{}'.format(self.venv_path, command)
+
+    def _exec_run(self, command, **kwargs):
+        return exec(self.wrap(command), cwd=self.path, processes=self.processes)
+
+    def exec_run(self, command, **kwargs):
         # Return results & error code
-        return self._exec_run(command)
+        return self._exec_run(self.venv_command(command))
+
+    def exec_stream(self, command, timeout=settings.VirtualEnv.COMMAND_TIMEOUT):
+        # Yields (stdout, stderr) chunks and returns the exit code, like Runnable.exec_stream
+        return engine.stream(self.wrap(self.venv_command(command)), cwd=self.path, timeout=timeout, processes=self.processes)
+
+    def clone(self, name, **kwargs):
+        # Child sandbox with everything installed in this one, its own copy since the agent can write to it
+        child = Container(self.image, name=name, provisioned=True, runner_installed=self.runner_installed, **kwargs)
+        copy_tree_cow(self.path, child.path)
+        # Entry point scripts name their interpreter by absolute path, point them at the clone's venv
+        bin_path = os.path.join(child.venv_path, 'bin')
+        old, new = self.venv_path.encode('utf8'), child.venv_path.encode('utf8')
+        for entry in os.scandir(bin_path):
+            if entry.is_symlink() or not entry.is_file():
+                continue
+            with open(entry.path, 'rb') as f:
+                content = f.read()
+            if old not in content:
+                continue
+            os.remove(entry.path)
+            with open(entry.path, 'wb') as f:
+                f.write(content.replace(old, new))
+            shutil.copymode(os.path.join(self.venv_path, 'bin', entry.name), entry.path)
+        return child
+
+    def attach(self, path):
+        # Packages in path (a read-only dependency layer) become importable in the venv
+        for site_packages in glob.glob(os.path.join(self.venv_path, 'lib', 'python*', 'site-packages')):
+            with open(os.path.join(site_packages, 'aivle-layer.pth'), 'w') as f:
+                f.write(path + '\n')
 
     def kill(self):
-        pass
+        for p in list(self.processes):
+            kill_tree(p.pid)
 
-    def remove(self):
-        # Delete virtualenv
-        self._exec_run('pyenv uninstall -f {}'.format(self.name))
-        # Move out of working dir
-        os.chdir(settings.BASE_PATH)
-        # Delete working dir
+    def remove(self, idle_io=False):
+        # Delete working dir (and the virtualenv inside it)
         print("Delete: {}".format(self.path))
+        if idle_io and shutil.which('ionice'):
+            # Idle I/O class, deleting a large tree must not slow down running jobs
+            exec('ionice -c 3 rm -rf {}'.format(shlex.quote(self.path)))
         shutil.rmtree(self.path, ignore_errors=True) # DANGEROUS!!!
 
 
+class Pool(object):
+    """
+    Keeps `size` provisioned sandboxes ready in the background. Ready sandboxes are
+    marker files in POOL_PATH, so they can be claimed from any worker process.
+    """
+    def __init__(self, size=settings.VirtualEnv.POOL_SIZE, path=POOL_PATH, interval=settings.VirtualEnv.POOL_INTERVAL):
+        self.size = size
+        self.path = path
+        self.interval = interval
+        self.runner_hash = utils.hash_dir(settings.RUNNER_PATH)
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def marker(self, name):
+        return os.path.join(self.path, name)
+
+    def markers(self):
+        try:
+            return sorted(os.listdir(self.path))
+        except FileNotFoundError:
+            return []
+
+    def is_current(self, name):
+        try:
+            with open(self.marker(name)) as f:
+                return f.read() == self.runner_hash
+        except FileNotFoundError:
+            return False
+
+    def ready(self):
+        return [name for name in self.markers() if not name.startswith('.') and self.is_current(name)]
+
+    def claim(self, name):
+        try:
+            os.remove(self.marker(name)) # atomic, only one process wins
+            return True
+        except FileNotFoundError:
+            return False
+
+    def acquire(self):
+        self.wakeup.set()
+        for name in self.ready():
+            if self.claim(name):
+                print('Pool: acquired', name)
+                return Container(settings.VirtualEnv.PYTHON_VERSION, name=name, provisioned=True, runner_installed=True)
+        print('Pool: empty')
+        return None
+
+    def prune(self):
+        # Sandboxes built with an older runner-kit
+        for name in self.markers():
+            if not name.startswith('.') and not self.is_current(name) and self.claim(name):
+                print('Pool: pruning', name)
+                Container(settings.VirtualEnv.PYTHON_VERSION, name=name).remove()
+
+    def fill(self):
+        while len(self.ready()) < self.size:
+            container = Container(settings.VirtualEnv.PYTHON_VERSION, name='aiVLE-pool-{}'.format(utils.generate_secure_string(16)))
+            container.provision()
+            if not container.runner_installed:
+                container.remove()
+                raise Exception('Sandbox provisioning failed')
+            os.makedirs(self.path, exist_ok=True)
+            tmp_marker = self.marker('.' + container.name)
+            with open(tmp_marker, 'w') as f:
+                f.write(self.runner_hash)
+            os.rename(tmp_marker, self.marker(container.name))
+            print('Pool: ready', container.name)
+
+    def loop(self):
+        while True:
+            try:
+                self.prune()
+                self.fill()
+            except Exception as e:
+                print('Pool: refill failed', e)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name='virtualenv-pool', daemon=True)
+            self.thread.start()
+
+
 class Containers(object):
+    def __init__(self, pool=None):
+        self.pool = pool
+
     def create(self, image, **kwargs):
-        return Container(settings.VirtualEnv.PYTHON_VERSION, **kwargs)
+        container = self.pool.acquire() if self.pool else None
+        if container is None:
+            return Container(settings.VirtualEnv.PYTHON_VERSION, **kwargs)
+        container.volumes = kwargs.get('volumes', {})
+        container.cpuset_cpus = kwargs.get('cpuset_cpus', None)
+        container.mem_limit = kwargs.get('mem_limit', None)
+        return container
+
+    def get(self, name):
+        return Container(settings.VirtualEnv.PYTHON_VERSION, name=name)
+
+    def list(self, all=True, filters={}):
+        # Sandboxes on disk, named like Docker containers of the runner
+        prefix = filters.get('name', 'aiVLE-')
+        try:
+            names = sorted(name for name in os.listdir(ROOT_PATH) if name.startswith(prefix))
+        except FileNotFoundError:
+            return []
+        return [self.get(name) for name in names]
 
 
 class Client(object):
@@ -149,15 +461,32 @@ class Client(object):
         self.images = Images()
         self.containers = Containers()
         self.networks = Networks()
+        self.wheelhouse_path = WHEELHOUSE_PATH
+        self.staging_path = STAGING_PATH
+        self.layers_path = LAYERS_PATH
+        if settings.VirtualEnv.POOL_SIZE > 0:
+            self.containers.pool = Pool()
+            # Worker processes only claim sandboxes, the main process refills the pool
+            if multiprocessing.current_process().name == 'MainProcess':
+                self.containers.pool.start()
 
 
 def init():
     TMP_SHARED_PATH = os.path.join(ROOT_PATH, 'shared_tmp')
     DEL_SHARED_PATH = os.path.join(ROOT_PATH, 'shared_del')
-    print('>>> Link:', settings.VirtualEnv.SHARED_PATH, SHARED_PATH)
-    # Copy to temporary path
-    print('Copying:', settings.VirtualEnv.SHARED_PATH, TMP_SHARED_PATH)
-    copy_tree(settings.VirtualEnv.SHARED_PATH, TMP_SHARED_PATH)
+    if settings.VirtualEnv.SHARED_PATH:
+        print('>>> Link:', settings.VirtualEnv.SHARED_PATH, SHARED_PATH)
+        # Copy to temporary path
+        print('Copying:', settings.VirtualEnv.SHARED_PATH, TMP_SHARED_PATH)
+        copy_tree(settings.VirtualEnv.SHARED_PATH, TMP_SHARED_PATH)
+    else:
+        os.makedirs(TMP_SHARED_PATH, exist_ok=True)
+    # Keep interpreters that were already built, cached wheels and dependency layers
+    for path in [PYENV_ROOT, WHEELHOUSE_PATH, LAYERS_PATH]:
+        tmp_path = os.path.join(TMP_SHARED_PATH, os.path.basename(path))
+        if os.path.isdir(path) and not os.path.exists(tmp_path):
+            print('Moving:', path, tmp_path)
+            shutil.move(path, tmp_path)
     # Move shared path to the del path
     if os.path.isdir(SHARED_PATH):
         print('Moving:', SHARED_PATH, DEL_SHARED_PATH)
@@ -168,6 +497,8 @@ def init():
     # Delete original shared path
     print('Deleting:', DEL_SHARED_PATH)
     shutil.rmtree(DEL_SHARED_PATH, ignore_errors=True)
+    # Build the interpreter once for all sandboxes
+    print('Building:', settings.VirtualEnv.PYTHON_VERSION, build_python())
 
 if __name__ == "__main__":
     init()
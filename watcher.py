@@ -1,18 +1,30 @@
 import requests
 import json
 import time
-import shutil
 import os
+import sys
+import signal
+import random
+import pickle
+import asyncio
 import logging
-import urllib3
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
 logger.setLevel("DEBUG")
 
-import settings, utils, core
+import settings, utils, core, metrics
+from api import API, file_lock
+from outbox import Outbox, Flusher
+from scheduler import Scheduler, TaskCache
+from memo import ResultCache
+from registry import pin
+
+outbox = Outbox()
+result_cache = ResultCache()
 
 class Status:
     QUEUED = 'Q'
@@ -20,44 +32,18 @@ class Status:
     ERROR = 'E'
     DONE = 'D'
 
-class BaseAPI(object):
-    def __init__(self, auth=None, verify=False):
-        self.session = requests.Session()
-        self.session.auth = auth
-        self.verify = verify
-        
-    def request(self, url, method='get', **kwargs):
-        assert method in ['get', 'post', 'delete', 'put']
-        response = getattr(self.session, method)(url, verify=self.verify, **kwargs)
-        return response
-        
-    def download(self, url, filepath):
-        response = self.session.get(url, stream=True)
-        with open(filepath, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        return response
-        
-class API(BaseAPI):
-    def __init__(self, base_url, auth=None):
-        super().__init__(auth=auth)
-        self.base_url = base_url
-        self.base = super()
-        
-    def request(self, id=None, action=None, method='get', **kwargs):
-        assert method in ['get', 'post', 'delete', 'put']
-        url = self.base_url
-        if id: url += str(id) + '/'
-        if action: url += format(action) + '/'
-        return super().request(url, method=method, **kwargs)
-
-
 class JobRunner(object):
     def __init__(self, job, *args, **kwargs):
         self.job = job
         self.task = None
         self.api = kwargs.get('api')
-        self.retry = kwargs.get('retry', 3)
-        self.retry_delay = kwargs.get('retry_delay', 10)
+        self.allocation = kwargs.get('allocation') # cores and memory from the scheduler
+        self.timings = metrics.Timings()
+        self.status = None
+        self.result_key = None
+        self.agent_hash = None
+        self.output = None
+        self.cache = None # 'hit' or 'miss' of the result cache
         
     def run_job(self):
         response = self.api.request(id=self.job['id'], action='run', method='post')
@@ -85,39 +71,86 @@ class JobRunner(object):
         return self.path('suite', self.task['id'])
     
     def maybe_download_suite(self):
-        if not os.path.isfile(self.suite_path):
-            logger.info('Suite not found, downloading...')
-            response = self.api.download(self.task['file_url'], self.suite_path)
-            if response.status_code != 200:
-                raise Exception('Suite download failed')
-
-        with open(self.suite_path, 'rb') as f:
-            file_hash = utils.hash_file(f)
-            if file_hash != self.task['file_hash']:
+        # Checked under the lock, a download in flight (e.g. a prefetch) is waited for instead of repeated
+        with file_lock(self.suite_path + '.fetch.lock'):
+            file_hash = core.artifact_index.hash(self.suite_path) if os.path.isfile(self.suite_path) else None
+            if file_hash is None:
+                logger.info('Suite not found, downloading...')
+            elif file_hash != self.task['file_hash']:
                 logger.info('Suite hash mismatch ({} != {}), updating...'.format(file_hash, self.task['file_hash']))
-                response = self.api.download(self.task['file_url'], self.suite_path)
-                if response.status_code != 200:
-                    raise Exception('Suite download failed')
+            else:
+                return
+            response = self.api.download(self.task['file_url'], self.suite_path, expected_hash=self.task['file_hash'])
+            if not response.ok:
+                raise Exception('Suite download failed')
+            core.artifact_index.record(self.suite_path, response.file_hash)
                     
     def maybe_download_agent(self):
         if self.job['runner'] == core.RunnerType.Python:
-            logger.info('Python runner, downloading agent...')
-            response = self.api.download(self.job['file_url'], self.agent_path)
-            if response.status_code != 200:
-                raise Exception('Agent download failed')
+            with file_lock(self.agent_path + '.fetch.lock'):
+                if core.artifact_index.lookup(self.agent_path):
+                    logger.info('Python runner, agent already downloaded')
+                    return
+                logger.info('Python runner, downloading agent...')
+                response = self.api.download(self.job['file_url'], self.agent_path)
+                if not response.ok:
+                    raise Exception('Agent download failed')
+                core.artifact_index.record(self.agent_path, response.file_hash)
+                core.artifact_index.dedupe(self.agent_path, response.file_hash)
                 
+    def agent_key(self):
+        # What the agent is made of: the zip content, or the digest a Docker tag points to now
+        if self.job['runner'] == core.RunnerType.Python:
+            return core.artifact_index.hash(self.agent_path)
+        if self.job['runner'] == core.RunnerType.Docker and core.registry:
+            return core.registry.digest(self.job['docker'])
+        return None
+
+    def cached_output(self):
+        # Result of an identical earlier run, unless the suite is marked nondeterministic
+        if not settings.ResultCache.ENABLED or not self.task.get('deterministic', True):
+            return None
+        agent_key = self.agent_hash = self.agent_key()
+        if not agent_key:
+            return None
+        self.result_key = result_cache.key(suite=self.task['file_hash'], agent=agent_key, runner=core.runner_hash(),
+            runner_type=self.job['runner'], run_time_limit=self.task['run_time_limit'], max_image_size=self.task['max_image_size'])
+        result_cache.invalidate(self.task['id'], self.task['file_hash'], core.runner_hash())
+        data = result_cache.get(self.result_key)
+        self.cache = 'hit' if data is not None else 'miss'
+        if data is None:
+            return None
+        logger.info('Job {}: result cache hit'.format(self.job['id']))
+        return None, data
+
+    def memoize(self, output):
+        error, data = output
+        if self.result_key and error is None:
+            result_cache.put(self.result_key, self.task['id'], self.task['file_hash'], core.runner_hash(), data)
+
     def runnable_run(self):
         options = {
             'runner_type': self.job['runner'],
             'run_time_limit': self.task['run_time_limit'],
-            'max_image_size': self.task['max_image_size']
+            'max_image_size': self.task['max_image_size'],
+            'suite_hash': self.task['file_hash'],
         }
         if options['runner_type'] == core.RunnerType.Docker:
             options['image'] = self.job['docker']
-        runnable = core.Runnable(self.task['id'], self.job['id'], **options)
-        return runnable.run()
+            if self.agent_hash:
+                # The image the result is cached under, even if the tag has moved since
+                options['image'] = pin(self.job['docker'], self.agent_hash)
+        if self.allocation:
+            options['cpus'] = self.allocation['cpus']
+            options['memory'] = self.allocation['memory']
+        runnable = core.Runnable(self.task['id'], self.job['id'], record=False, reap=settings.Reaper.ENABLED, **options)
+        try:
+            return runnable.run()
+        finally:
+            self.timings.update(runnable.timings.phases)
     
     def process(self, output):
+        self.output = output
         error, result = output
         if error:
             notes = {
@@ -137,77 +170,531 @@ class JobRunner(object):
         return data
 
     def end(self, data):
+        # Posted by the outbox flusher of the watcher, never blocks the worker
+        with self.timings.phase('result_queue'):
+            outbox.put(self.job['id'], data)
+        self.status = data['status']
+        self.record()
+
+    def record(self):
+        # Local history of results, with the timings of the whole job
+        error, data = self.output
+        agent_hash = self.agent_hash
+        if agent_hash is None and self.task and self.job['runner'] == core.RunnerType.Python:
+            agent_hash = core.artifact_index.lookup(self.agent_path)
         try:
-            response = self.api.request(id=self.job['id'], action='end', method='post', json=data)
-            output = (response.status_code, response.text)
-        except:
-            output = (-1, None)
-        if output[0] != 200:
-            logger.error('End failed: {}'.format(output))
-            if self.retry > 0:
-                time.sleep(self.retry_delay)
-                logger.info('Retrying... [{}]'.format(self.retry))
-                self.retry -= 1
-                self.end(data)
-            else:
-                logger.info('Max retry reached')
+            core.result_store.record(self.task['id'] if self.task else None, self.job['id'], data=data, error=error,
+                phases=self.timings.phases, runner=self.job['runner'], suite_hash=self.task and self.task.get('file_hash'),
+                agent_hash=agent_hash, cached=self.cache == 'hit')
+        except Exception as e:
+            logger.error('Job {}: result not recorded: {}'.format(self.job['id'], e))
+
+    def report(self):
+        # Sent back to the watcher process, which owns the metrics
+        return {'job': self.job['id'], 'task': self.task['id'] if self.task else None, 'runner': self.job['runner'],
+            'phases': self.timings.phases, 'status': self.status, 'cache': self.cache}
     
     def run(self):
         try:
-            self.run_job()
+            with self.timings.phase('claim'):
+                self.run_job()
         except:
-            return # Task was taken by another process
+            return False # Task was taken by another process
         try:
-            self.get_task()
-            self.maybe_download_suite()
-            self.maybe_download_agent()
-            output = self.runnable_run()
+            with self.timings.phase('task_fetch'):
+                self.get_task()
+            with self.timings.phase('suite_download'):
+                self.maybe_download_suite()
+            with self.timings.phase('agent_download'):
+                self.maybe_download_agent()
+            output = self.cached_output()
+            if output is None:
+                output = self.runnable_run()
+                self.memoize(output)
         except Exception as e:
             logger.error(e)
             output = (e, None)
         finally:
             data = self.process(output)
             self.end(data)
+        return True
 
             
+class PollStats(object):
+    def __init__(self):
+        self.polls = 0
+        self.errors = 0
+        self.empty = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.claims = 0
+        self.conflicts = 0
+
+    def poll(self, latency, ok=True, jobs=0):
+        self.polls += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        if not ok:
+            self.errors += 1
+        elif jobs == 0:
+            self.empty += 1
+        metrics.registry.observe('aivle_runner_poll_seconds', latency)
+        metrics.registry.inc('aivle_runner_polls_total', (('result', 'error' if not ok else 'empty' if jobs == 0 else 'jobs'),))
+        metrics.registry.set('aivle_runner_poll_empty_ratio', self.empty / self.polls)
+        if self.polls % settings.Watcher.STATS_EVERY == 0:
+            logger.info('Poll stats: {}'.format(self.summary()))
+
+    def claim(self, ok):
+        self.claims += 1
+        if not ok:
+            self.conflicts += 1
+        metrics.registry.inc('aivle_runner_claims_total', (('result', 'claimed' if ok else 'conflict'),))
+        metrics.registry.set('aivle_runner_claim_conflict_ratio', self.conflicts / self.claims)
+
+    def summary(self):
+        return {
+            'polls': self.polls,
+            'errors': self.errors,
+            'empty': self.empty,
+            'latency_avg': self.latency_total / self.polls if self.polls else 0,
+            'latency_max': self.latency_max,
+            'claims': self.claims,
+            'conflicts': self.conflicts,
+            'conflict_rate': self.conflicts / self.claims if self.claims else 0,
+        }
+
+
+def pick_jobs(jobs, count, spread=settings.Watcher.CLAIM_SPREAD, first=None):
+    # Runners polling the same queue would all race for its head, spread claims over a window instead.
+    # first: the job the scheduler holds cores and memory for, always tried
+    window = jobs[:count * spread]
+    picked = [window[i] for i in sorted(random.sample(range(len(window)), min(count, len(window))))]
+    if first is not None:
+        picked = ([job for job in jobs if job['id'] == first] + [job for job in picked if job['id'] != first])[:count]
+    return picked
+
+
 class Watcher(object):
     def __init__(self, api, sleep=settings.Watcher.SLEEP, **kwargs):
         self.api = api
         self.sleep = sleep
+        self.backoff = utils.Backoff(sleep, settings.Watcher.MIN_SLEEP, max(sleep, settings.Watcher.MAX_SLEEP), jitter=settings.Watcher.JITTER)
+        self.stats = PollStats()
+        self.flusher = Flusher(api, outbox)
+        self.flusher.start()
+        core.reaper.start()
+        self.stopping = threading.Event()
         
     def watch(self):
         more = True
-        while True:
-            if not more:
-                time.sleep(self.sleep)
-            try:
-                r = self.api.request()
-                if r.status_code != 200:
+        try:
+            while not self.stopping.is_set():
+                if not more:
+                    if self.stopping.wait(self.backoff.next()):
+                        break
+                start = time.time()
+                try:
+                    r = self.api.request()
+                    if r.status_code != 200:
+                        self.stats.poll(time.time() - start, ok=False)
+                        self.backoff.idle()
+                        more = False
+                        logger.error(r.status_code)
+                        continue
+                    data = r.json()
+                    self.stats.poll(time.time() - start, jobs=len(data))
+                    metrics.registry.set('aivle_runner_queue_depth', len(data))
+                    if len(data) > 0:
+                        self.backoff.busy()
+                    else:
+                        self.backoff.idle()
+                    more = self.handler(data)
+                except requests.exceptions.ConnectionError as e:
+                    logger.info('Can\'t connect to aiVLE')
+                    self.stats.poll(time.time() - start, ok=False)
+                    self.backoff.idle()
                     more = False
-                    logger.error(r.status_code)
-                    continue
-                more = self.handler(r.json())
-            except requests.exceptions.ConnectionError as e:
-                logger.info('Can\'t connect to aiVLE')
-                more = False
+        finally:
+            self.close()
             
     def handler(self, data):
         raise NotImplemented
+
+    def close(self):
+        self.flusher.stop()
+        core.reaper.stop()
+
+
+def init_worker():
+    # Let the watcher decide when to stop, running jobs always finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Docker client connections must not be shared with the parent process
+    if settings.Runner.USE_DOCKER:
+        core.client = core.get_client()
+
+def run_job(job, api, allocation=None):
+    job_runner = JobRunner(job, api=api, allocation=allocation)
+    claimed = job_runner.run()
+    return claimed, job_runner.report() if claimed else None
+
+
+class Prefetcher(object):
+    """
+    Downloads the inputs (suite, agent, Docker image) of queued jobs while earlier jobs are grading.
+    At most `depth` jobs are prefetched ahead, using at most `max_size` KB of disk.
+    A job that starts while its inputs are in flight waits for them: downloads are under per-file
+    locks and image pulls under per-image locks of the image cache. An image is pulled once at a time here,
+    a pull that outlives its time limit keeps running and is not started again.
+    """
+    def __init__(self, api, depth=settings.Watcher.PREFETCH_DEPTH, max_size=settings.Watcher.PREFETCH_MAX_SIZE,
+        workers=settings.Watcher.PREFETCH_WORKERS):
+        self.api = api
+        self.depth = depth
+        self.max_size = max_size
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pull_pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.pending = {} # job id -> future
+        self.sizes = {} # job id -> KB
+        self.pulls = {} # image -> future, until the pull is done
+
+    @property
+    def used(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def fetch(self, job):
+        job_runner = JobRunner(job, api=self.api)
+        job_runner.get_task()
+        job_runner.maybe_download_suite()
+        job_runner.maybe_download_agent()
+        size = os.path.getsize(job_runner.agent_path) / 1000 if os.path.isfile(job_runner.agent_path) else 0
+        if job['runner'] == core.RunnerType.Docker and core.image_cache:
+            # Same limits as the job itself, images of unknown size are left to it
+            image_size = core.registry.image_size(job['docker'])
+            if image_size is not None and image_size / 1000 <= job_runner.task['max_image_size']:
+                future, started = self.pull(job['docker'])
+                if started:
+                    future.result(timeout=settings.Runner.PULL_TIME_LIMIT)
+                size += image_size / 1000
+        with self.lock:
+            if job['id'] in self.pending: # not started or gone meanwhile
+                self.sizes[job['id']] = size
+        logger.info('Prefetched job {} ({:.0f} KB)'.format(job['id'], size))
+
+    def pull(self, image):
+        # Returns the pull of the image and whether it was started now, rather than already running
+        with self.lock:
+            future = self.pulls.get(image)
+            if future is not None:
+                return future, False
+            future = self.pulls[image] = self.pull_pool.submit(core.image_cache.pull, image)
+        future.add_done_callback(lambda f: self.pulled(image))
+        return future, True
+
+    def pulled(self, image):
+        with self.lock:
+            self.pulls.pop(image, None)
+
+    def done(self, future, job_id):
+        if future.exception():
+            # Retried on a later poll if the job is still queued
+            logger.info('Prefetch of job {} failed: {}'.format(job_id, future.exception()))
+            self.release(job_id)
+
+    def prefetch(self, jobs):
+        # Forget jobs that left the queue (claimed elsewhere)
+        queued = set(job['id'] for job in jobs)
+        with self.lock:
+            left = [job_id for job_id in self.pending if job_id not in queued]
+        for job_id in left:
+            self.release(job_id)
+        for job in jobs[:self.depth]:
+            with self.lock:
+                if job['id'] in self.pending:
+                    continue
+            if self.used >= self.max_size:
+                logger.info('Prefetch disk budget reached ({:.0f} KB)'.format(self.used))
+                break
+            with self.lock:
+                future = self.pool.submit(self.fetch, job)
+                self.pending[job['id']] = future
+            future.add_done_callback(lambda f, job_id=job['id']: self.done(f, job_id))
+
+    def release(self, job_id):
+        with self.lock:
+            self.pending.pop(job_id, None)
+            self.sizes.pop(job_id, None)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.pull_pool.shutdown(wait=False)
+
             
 class JobWatcher(Watcher):
     def __init__(self, *args, **kwargs):
         self.processes = kwargs.pop('processes', settings.Watcher.PROCESSES)
+        initializer = kwargs.pop('initializer', init_worker)
+        initargs = kwargs.pop('initargs', ())
         super().__init__(*args, **kwargs)
+        # Workers are not forked from this (threaded) process, see Prefetcher
+        context = multiprocessing.get_context('forkserver')
+        self.pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context, initializer=initializer, initargs=initargs)
+        self.running = {} # future -> job id
+        self.allocations = {} # future -> scheduler allocation
+        self.prefetcher = Prefetcher(self.api)
+        self.scheduler = Scheduler()
+        self.tasks = TaskCache(self.api)
+
+    @property
+    def free_slots(self):
+        return self.processes - len(self.running)
+
+    def reap(self, block=False):
+        if block and self.running:
+            wait(list(self.running), return_when=FIRST_COMPLETED)
+        for future in [f for f in self.running if f.done()]:
+            job_id = self.running.pop(future)
+            self.scheduler.release(self.allocations.pop(future, None))
+            metrics.registry.set_busy(len(self.running))
+            if future.exception():
+                logger.error('Job {} crashed: {}'.format(job_id, future.exception()))
+            else:
+                claimed, report = future.result()
+                self.stats.claim(claimed)
+                if report:
+                    metrics.registry.observe_job(**report)
+
+    def allocate(self, job):
+        try:
+            task = self.tasks.get(job['task'])
+        except Exception as e:
+            logger.info('Task of job {} unavailable ({}), default needs assumed'.format(job['id'], e))
+            task = None
+        return self.scheduler.allocate(task, job['id'])
+
+    def submit(self, job, allocation=None):
+        logger.info('Starting job {} ({}/{} slots busy, cores {})'.format(job['id'], len(self.running) + 1, self.processes,
+            allocation and allocation['cpus']))
+        future = self.pool.submit(run_job, job, self.api, allocation)
+        self.running[future] = job['id']
+        self.allocations[future] = allocation
+        metrics.registry.set_busy(len(self.running))
         
     def handler(self, data):
-        if len(data) == 0:
+        self.reap()
+        self.scheduler.queued(set(job['id'] for job in data))
+        jobs = [job for job in data if job['id'] not in self.running.values()]
+        if len(jobs) == 0:
             return False
-        for job in data[:self.processes]:
-            job_runner = JobRunner(job, api=self.api)
-            job_runner.run()
-        return len(data) - len(data[:self.processes]) > 0
+        submitted = []
+        # Jobs that do not fit the free cores and memory stay queued, smaller ones behind them may
+        for job in pick_jobs(jobs, self.free_slots, first=self.scheduler.reserved):
+            allocation = self.allocate(job)
+            if allocation is None:
+                continue
+            submitted.append(job)
+            self.prefetcher.release(job['id'])
+            self.submit(job, allocation)
+        self.prefetcher.prefetch([job for job in jobs if job not in submitted])
+        if len(jobs) > len(submitted) and self.running:
+            # Queue has more work than free slots, poll again once a slot frees up.
+            # With nothing running, jobs were held back for cores or memory and the next poll waits as usual.
+            self.reap(block=True)
+            return True
+        return False
 
-    
-api = API(settings.Watcher.API, (settings.Watcher.USERNAME, settings.Watcher.PASSWORD))
-watcher = JobWatcher(api, sleep=settings.Watcher.SLEEP, processes=settings.Watcher.PROCESSES)
-watcher.watch()
+    def close(self):
+        logger.info('Waiting for {} running job(s) to finish...'.format(len(self.running)))
+        self.prefetcher.close()
+        self.pool.shutdown(wait=True)
+        self.running = {}
+        super().close()
+
+
+def run_runnable(job_runner):
+    # Runs in a worker process, the error has to survive pickling on its way back
+    error, data = job_runner.runnable_run()
+    if error is not None:
+        try:
+            pickle.dumps(error)
+        except Exception:
+            error = Exception(type(error).__name__, *[str(arg) for arg in error.args])
+    return (error, data), job_runner.timings.phases
+
+
+class AsyncJobWatcher(object):
+    """
+    Watcher where polling, claiming, downloads, container runs and result posting are concurrent
+    asyncio tasks. Blocking work goes to bounded executors: API calls and downloads to thread pools,
+    containers to worker processes, so no thread is held per job.
+    """
+    def __init__(self, api, sleep=settings.Watcher.SLEEP, processes=settings.Watcher.PROCESSES,
+        downloads=settings.Watcher.DOWNLOADS, requests=settings.Watcher.REQUESTS, initializer=init_worker, initargs=()):
+        self.api = api
+        self.sleep = sleep
+        self.processes = processes
+        context = multiprocessing.get_context('forkserver')
+        self.container_pool = ProcessPoolExecutor(max_workers=processes, mp_context=context, initializer=initializer, initargs=initargs)
+        self.download_pool = ThreadPoolExecutor(max_workers=downloads)
+        self.api_pool = ThreadPoolExecutor(max_workers=requests)
+        self.prefetcher = Prefetcher(api)
+        self.scheduler = Scheduler()
+        self.task_cache = TaskCache(api)
+        self.tasks = {} # job id -> asyncio task
+        self.busy = 0 # jobs between claim and the end of their container run
+        self.stopping = None
+        self.slot_freed = None
+        self.backoff = utils.Backoff(sleep, settings.Watcher.MIN_SLEEP, max(sleep, settings.Watcher.MAX_SLEEP), jitter=settings.Watcher.JITTER)
+        self.stats = PollStats()
+        self.flusher = Flusher(api, outbox)
+
+    async def call(self, executor, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    async def process(self, job, allocation=None):
+        job_runner = JobRunner(job, api=self.api, allocation=allocation)
+        try:
+            try:
+                with job_runner.timings.phase('claim'):
+                    await self.call(self.api_pool, job_runner.run_job)
+            except Exception:
+                self.stats.claim(False)
+                return # Task was taken by another process
+            self.stats.claim(True)
+            try:
+                with job_runner.timings.phase('task_fetch'):
+                    await self.call(self.api_pool, job_runner.get_task)
+                # Concurrent downloads, the two phases overlap
+                await asyncio.gather(
+                    self.call(self.download_pool, self.timed, job_runner, 'suite_download', job_runner.maybe_download_suite),
+                    self.call(self.download_pool, self.timed, job_runner, 'agent_download', job_runner.maybe_download_agent))
+                output = await self.call(self.api_pool, job_runner.cached_output)
+                if output is None:
+                    output, phases = await self.call(self.container_pool, run_runnable, job_runner)
+                    job_runner.timings.update(phases)
+                    await self.call(self.api_pool, job_runner.memoize, output)
+            except Exception as e:
+                logger.error(e)
+                output = (e, None)
+        finally:
+            # Posting the result does not hold a slot
+            self.busy -= 1
+            self.scheduler.release(allocation)
+            metrics.registry.set_busy(self.busy)
+            self.slot_freed.set()
+        data = job_runner.process(output)
+        # The outbox fsyncs and the result store writes to SQLite, neither belongs on the loop
+        await self.call(self.api_pool, job_runner.end, data)
+        metrics.registry.observe_job(**job_runner.report())
+
+    @staticmethod
+    def timed(job_runner, name, func):
+        with job_runner.timings.phase(name):
+            return func()
+
+    async def allocate(self, job):
+        try:
+            task = await self.call(self.api_pool, self.task_cache.get, job['task'])
+        except Exception as e:
+            logger.info('Task of job {} unavailable ({}), default needs assumed'.format(job['id'], e))
+            task = None
+        return self.scheduler.allocate(task, job['id'])
+
+    def start(self, job, allocation=None):
+        logger.info('Starting job {} ({}/{} slots busy, cores {})'.format(job['id'], self.busy + 1, self.processes,
+            allocation and allocation['cpus']))
+        self.busy += 1
+        metrics.registry.set_busy(self.busy)
+        task = asyncio.ensure_future(self.process(job, allocation))
+        self.tasks[job['id']] = task
+        task.add_done_callback(lambda t, job_id=job['id']: self.tasks.pop(job_id, None))
+
+    async def poll(self):
+        free = self.processes - self.busy
+        if free <= 0:
+            return False
+        start = time.time()
+        try:
+            r = await self.call(self.api_pool, self.api.request)
+        except requests.exceptions.ConnectionError:
+            logger.info('Can\'t connect to aiVLE')
+            self.stats.poll(time.time() - start, ok=False)
+            self.backoff.idle()
+            return False
+        if r.status_code != 200:
+            logger.error(r.status_code)
+            self.stats.poll(time.time() - start, ok=False)
+            self.backoff.idle()
+            return False
+        data = r.json()
+        self.stats.poll(time.time() - start, jobs=len(data))
+        metrics.registry.set('aivle_runner_queue_depth', len(data))
+        if len(data) > 0:
+            self.backoff.busy()
+        else:
+            self.backoff.idle()
+        self.scheduler.queued(set(job['id'] for job in data))
+        jobs = [job for job in data if job['id'] not in self.tasks]
+        started = []
+        # Jobs that do not fit the free cores and memory stay queued, smaller ones behind them may
+        for job in pick_jobs(jobs, free, first=self.scheduler.reserved):
+            allocation = await self.allocate(job)
+            if allocation is None:
+                continue
+            started.append(job)
+            self.prefetcher.release(job['id'])
+            self.start(job, allocation)
+        self.prefetcher.prefetch([job for job in jobs if job not in started])
+        return len(started) > 0 and len(jobs) > len(started)
+
+    async def wait(self, timeout):
+        # Until the timeout, a free slot or a stop request
+        self.slot_freed.clear()
+        waiters = [asyncio.ensure_future(self.stopping.wait()), asyncio.ensure_future(self.slot_freed.wait())]
+        done, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+
+    async def watch(self):
+        self.stopping = asyncio.Event()
+        self.slot_freed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(signum, self.stopping.set)
+        self.flusher.start()
+        core.reaper.start()
+        try:
+            while not self.stopping.is_set():
+                more = await self.poll()
+                if not more:
+                    await self.wait(self.backoff.next())
+        finally:
+            logger.info('Waiting for {} running job(s) to finish...'.format(len(self.tasks)))
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+            self.close()
+
+    def close(self):
+        self.prefetcher.close()
+        self.container_pool.shutdown(wait=True)
+        self.download_pool.shutdown(wait=True)
+        self.api_pool.shutdown(wait=True)
+        self.flusher.stop()
+        core.reaper.stop()
+
+
+def shutdown(signum, frame):
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    api = API(settings.Watcher.API, (settings.Watcher.USERNAME, settings.Watcher.PASSWORD))
+    metrics.Exporter().start()
+    if settings.Watcher.USE_ASYNC:
+        watcher = AsyncJobWatcher(api, sleep=settings.Watcher.SLEEP, processes=settings.Watcher.PROCESSES)
+        asyncio.run(watcher.watch())
+    else:
+        signal.signal(signal.SIGTERM, shutdown)
+        watcher = JobWatcher(api, sleep=settings.Watcher.SLEEP, processes=settings.Watcher.PROCESSES)
+        watcher.watch()
@@ -0,0 +1,145 @@
+import os
+import shutil
+import hashlib
+import logging
+
+import settings
+import utils
+
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel("DEBUG")
+
+
+def wheel_requirement(filename):
+    # {distribution}-{version}(-{build tag})?-{python tag}-{abi tag}-{platform tag}.whl
+    name, version = filename.split('-')[:2]
+    return '{}=={}'.format(name, version)
+
+def sha256(path, block_size=65536):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block_size), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def disk_usage(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def publish(tmp_path, path):
+    # Atomic, the first job to commit a key wins
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True) # committed by another job meanwhile
+
+def evict(paths, max_size, name):
+    # Least recently used first (entries are touched on use), sizes in KB like the other settings
+    entries = []
+    for path in paths:
+        try:
+            entries.append((os.path.getmtime(path), disk_usage(path), path))
+        except FileNotFoundError:
+            pass
+    entries.sort()
+    total = sum(size for _, size, _ in entries) / 1000
+    while entries and total > max_size:
+        _, size, path = entries.pop(0)
+        logger.info('{}: evicting {}'.format(name, path))
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size / 1000
+
+
+class Wheelhouse(object):
+    """
+    Host-side wheel cache, the parts a job installs are mounted read-only into its container.
+
+    artifacts/<key>/  wheels of one artifact (runner-kit, suite) and its dependencies, pinned in requirements.txt
+    deps/             wheels of trusted builds (runner-kit, suites), used as --find-links when building
+    staging/<name>/   per-container writable dir where new wheels are built (staging_path, if given)
+    """
+    def __init__(self, path=settings.Wheelhouse.PATH, max_size=settings.Wheelhouse.MAX_SIZE, staging_path=None):
+        self.path = path
+        self.max_size = max_size
+        self.artifacts_path = os.path.join(path, 'artifacts')
+        self.deps_path = os.path.join(path, 'deps')
+        self.staging_path = staging_path or os.path.join(path, 'staging')
+        for p in [self.artifacts_path, self.deps_path, self.staging_path]:
+            os.makedirs(p, exist_ok=True)
+
+    def artifact_path(self, key):
+        return os.path.join(self.artifacts_path, key)
+
+    def has(self, key):
+        return os.path.isfile(os.path.join(self.artifact_path(key), 'requirements.txt'))
+
+    def touch(self, key):
+        try:
+            os.utime(self.artifact_path(key))
+        except FileNotFoundError:
+            pass
+
+    def staging(self, name):
+        path = os.path.join(self.staging_path, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def discard(self, name):
+        shutil.rmtree(os.path.join(self.staging_path, name), ignore_errors=True)
+
+    def purge(self, prefix):
+        # Artifacts that are no longer cached, e.g. agents committed by earlier versions
+        for name in os.listdir(self.artifacts_path):
+            if name.startswith(prefix):
+                logger.info('Wheelhouse: purging {}'.format(name))
+                shutil.rmtree(self.artifact_path(name), ignore_errors=True)
+
+    def commit(self, key, wheels_path, hashes=None):
+        # hashes: sha256 per wheel from pip's report of a trusted build, only such wheels are shared in deps/.
+        # Anything else (agents, student images) may have been tampered with and stays under its own key.
+        wheels = sorted(f for f in os.listdir(wheels_path) if f.endswith('.whl'))
+        if not wheels:
+            return False
+        # Pinned next to the build too, the job installs from there
+        with open(os.path.join(wheels_path, 'requirements.txt'), 'w') as f:
+            f.write('\n'.join(wheel_requirement(wheel) for wheel in wheels) + '\n')
+        tmp_path = os.path.join(self.artifacts_path, '.{}-{}'.format(key, utils.generate_secure_string(8)))
+        os.makedirs(tmp_path)
+        shutil.copy(os.path.join(wheels_path, 'requirements.txt'), tmp_path)
+        for wheel in wheels:
+            shutil.copy(os.path.join(wheels_path, wheel), tmp_path)
+            if hashes is not None and hashes.get(wheel) != sha256(os.path.join(tmp_path, wheel)):
+                logger.error('Wheelhouse: {} does not match its build report, {} not committed'.format(wheel, key))
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return False
+        if hashes is not None:
+            for wheel in wheels:
+                dep_path = os.path.join(self.deps_path, wheel)
+                if not os.path.exists(dep_path):
+                    tmp_dep_path = os.path.join(self.deps_path, '.{}-{}'.format(wheel, utils.generate_secure_string(8)))
+                    shutil.copy(os.path.join(tmp_path, wheel), tmp_dep_path)
+                    os.replace(tmp_dep_path, dep_path)
+        publish(tmp_path, self.artifact_path(key))
+        logger.info('Wheelhouse: committed {} ({} wheels)'.format(key, len(wheels)))
+        self.evict()
+        return True
+
+    def evict(self):
+        evict([os.path.join(base, name) for base in [self.artifacts_path, self.deps_path]
+            for name in os.listdir(base) if not name.startswith('.')], self.max_size, 'Wheelhouse')